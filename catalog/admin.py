@@ -1,16 +1,63 @@
+from functools import lru_cache
+
 from django.contrib import admin
-from .models import Platform, Genre, Title
+from .models import CatalogChange, Platform, Genre, Title, TMDBReference
 from django.contrib import messages
-from django.urls import path, reverse
+from django.urls import get_script_prefix, path, reverse
 from django.shortcuts import redirect
-from django.utils.safestring import mark_safe
-from . import tmdb
+from django.utils.html import format_html_join
+from . import prerender, tmdb
+from .admin_paging import LargeTableAdminMixin
+
+# (url name suffix, kind, label) of the per-platform buttons
+PLATFORM_ACTIONS = (
+    ('generate', 'movies', 'Gen M'),
+    ('generate', 'series', 'Gen S'),
+    ('update', 'movies', 'Upd M'),
+    ('update', 'series', 'Upd S'),
+    ('delete', 'movies', 'Del M'),
+    ('delete', 'series', 'Del S'),
+)
+_PK_PLACEHOLDER = '__pk__'
+
+
+@lru_cache(maxsize=8)
+def _platform_action_urls(script_prefix):
+    """Action URL patterns with a pk placeholder, reversed once per script prefix instead of per row."""
+    return tuple(
+        (reverse(f'admin:catalog_platform_{name}', args=[_PK_PLACEHOLDER]) + f'?kind={kind}', label)
+        for name, kind, label in PLATFORM_ACTIONS
+    )
+
+
+class PrerenderOnChangeMixin:
+    """Refresh the pre-rendered library pages after any admin change."""
+
+    def save_related(self, request, form, formsets, change):
+        # runs after save_model, once M2M (genres) are saved too
+        super().save_related(request, form, formsets, change)
+        prerender.schedule_prerender()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        prerender.schedule_prerender()
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        prerender.schedule_prerender()
 
 
 @admin.register(Platform)
-class PlatformAdmin(admin.ModelAdmin):
+class PlatformAdmin(PrerenderOnChangeMixin, admin.ModelAdmin):
     list_display = ('name', 'slug', 'tmdb_provider_id', 'admin_actions')
-    actions = ['refresh_movies_from_tmdb', 'refresh_series_from_tmdb']
+    search_fields = ('name',)
+    actions = ['refresh_movies_from_tmdb', 'refresh_series_from_tmdb', 'generate_all_regions']
+
+    def get_deleted_objects(self, objs, request):
+        deleted, model_count, perms_needed, protected = super().get_deleted_objects(objs, request)
+        # change feed rows cannot be deleted on their own, but they go with their platform
+        perms_needed.discard(CatalogChange._meta.verbose_name)
+        return deleted, model_count, perms_needed, protected
 
     def get_urls(self):
         urls = super().get_urls()
@@ -22,28 +69,16 @@ class PlatformAdmin(admin.ModelAdmin):
         return my_urls + urls
 
     def admin_actions(self, obj):
-        gen_movies = reverse('admin:catalog_platform_generate', args=[obj.pk]) + '?kind=movies'
-        gen_series = reverse('admin:catalog_platform_generate', args=[obj.pk]) + '?kind=series'
-        upd_movies = reverse('admin:catalog_platform_update', args=[obj.pk]) + '?kind=movies'
-        upd_series = reverse('admin:catalog_platform_update', args=[obj.pk]) + '?kind=series'
-        del_movies = reverse('admin:catalog_platform_delete', args=[obj.pk]) + '?kind=movies'
-        del_series = reverse('admin:catalog_platform_delete', args=[obj.pk]) + '?kind=series'
-        html = (
-            f"<a class=\"button\" href=\"{gen_movies}\">Gen M</a> "
-            f"<a class=\"button\" href=\"{gen_series}\">Gen S</a> "
-            f"<a class=\"button\" href=\"{upd_movies}\">Upd M</a> "
-            f"<a class=\"button\" href=\"{upd_series}\">Upd S</a> "
-            f"<a class=\"button\" href=\"{del_movies}\">Del M</a> "
-            f"<a class=\"button\" href=\"{del_series}\">Del S</a>"
-        )
-        return mark_safe(html)
+        urls = _platform_action_urls(get_script_prefix())
+        return format_html_join(' ', '<a class="button" href="{}">{}</a>',
+                                ((url.replace(_PK_PLACEHOLDER, str(obj.pk)), label) for url, label in urls))
 
     admin_actions.short_description = 'Actions'
 
     def refresh_movies_from_tmdb(self, request, queryset):
         for platform in queryset:
             try:
-                path, count = tmdb.generate_platform(platform, kind='movies')
+                path, count = tmdb.generate_platform(platform, kind='movies', resume=True)
                 self.message_user(request, f"Generated movies for {platform.name}: {count} items saved to {path}")
             except Exception as e:
                 self.message_user(request, f"Error generating {platform.name}: {e}", level=messages.ERROR)
@@ -53,19 +88,33 @@ class PlatformAdmin(admin.ModelAdmin):
     def refresh_series_from_tmdb(self, request, queryset):
         for platform in queryset:
             try:
-                path, count = tmdb.generate_platform(platform, kind='series')
+                path, count = tmdb.generate_platform(platform, kind='series', resume=True)
                 self.message_user(request, f"Generated series for {platform.name}: {count} items saved to {path}")
             except Exception as e:
                 self.message_user(request, f"Error generating {platform.name}: {e}", level=messages.ERROR)
 
     refresh_series_from_tmdb.short_description = 'Refresh series from TMDB and save JSON'
 
+    def generate_all_regions(self, request, queryset):
+        try:
+            plan, created, requests = tmdb.generate_planned(list(queryset))
+        except Exception as e:
+            self.message_user(request, f"Error generating: {e}", level=messages.ERROR)
+            return
+        total = sum(created.values())
+        self.message_user(request, f"Generated {total} items for {', '.join(tmdb.sync_regions())} "
+                                   f"with {requests} TMDB requests (naive plan: {plan.naive_requests})")
+
+    generate_all_regions.short_description = 'Generate movies and series for every sync region (one request plan)'
+
     # Admin custom views
     def generate_view(self, request, object_id):
         obj = self.get_object(request, object_id)
         kind = request.GET.get('kind', 'movies')
+        # an interrupted sync continues from its last completed page; ?resume=0 starts over
+        resume = request.GET.get('resume') != '0'
         try:
-            path, count = tmdb.generate_platform(obj, kind=kind)
+            path, count = tmdb.generate_platform(obj, kind=kind, resume=resume)
             self.message_user(request, f"Generated {kind} for {obj.name}: {count} items saved to {path}")
         except Exception as e:
             self.message_user(request, f"Error: {e}", level=messages.ERROR)
@@ -74,8 +123,10 @@ class PlatformAdmin(admin.ModelAdmin):
     def update_view(self, request, object_id):
         obj = self.get_object(request, object_id)
         kind = request.GET.get('kind', 'movies')
+        # an interrupted sync continues from its last completed page; ?resume=0 starts over
+        resume = request.GET.get('resume') != '0'
         try:
-            path, count = tmdb.update_platform(obj, kind=kind)
+            path, count = tmdb.update_platform(obj, kind=kind, resume=resume)
             self.message_user(request, f"Updated {kind} for {obj.name}: {count} new items saved to {path}")
         except Exception as e:
             self.message_user(request, f"Error: {e}", level=messages.ERROR)
@@ -94,12 +145,40 @@ class PlatformAdmin(admin.ModelAdmin):
 
 
 @admin.register(Genre)
-class GenreAdmin(admin.ModelAdmin):
+class GenreAdmin(PrerenderOnChangeMixin, admin.ModelAdmin):
     list_display = ('name', 'slug')
+    # used by TitleAdmin's autocomplete
+    search_fields = ('name',)
 
 
 @admin.register(Title)
-class TitleAdmin(admin.ModelAdmin):
+class TitleAdmin(PrerenderOnChangeMixin, LargeTableAdminMixin, admin.ModelAdmin):
     list_display = ('title', 'platform', 'type', 'popularity')
-    list_filter = ('type', 'platform')
+    list_filter = ('type', 'platform', 'is_live')
+    list_select_related = ('platform',)
+    # icontains on title is served by the trigram index on Postgres (migration 0007)
     search_fields = ('title',)
+    autocomplete_fields = ('platform', 'genres')
+
+
+@admin.register(TMDBReference)
+class TMDBReferenceAdmin(admin.ModelAdmin):
+    list_display = ('key', 'version', 'fetched_at')
+
+
+@admin.register(CatalogChange)
+class CatalogChangeAdmin(LargeTableAdminMixin, admin.ModelAdmin):
+    list_display = ('id', 'change', 'title', 'platform', 'type', 'popularity', 'previous_popularity', 'created_at')
+    list_select_related = ('platform',)
+    list_filter = ('change', 'platform', 'type')
+    search_fields = ('title',)
+
+    # the feed is append-only (rows only go away with their platform)
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,122 @@
+"""
+Admin changelists for large tables (Title: 100k+ rows).
+
+- Counts are estimated: an unfiltered changelist on Postgres reads `reltuples`
+  from pg_class, filtered ones count at most settings.ADMIN_COUNT_LIMIT rows.
+- With the default ordering (newest first) pages are fetched with a keyset cursor
+  (`?cursor=<pk>` → `pk < cursor`) instead of OFFSET, so page 5000 costs the same
+  as page 1. Sorting by a column falls back to numbered pages.
+"""
+from functools import cached_property
+
+from django.conf import settings
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+
+CURSOR_VAR = 'cursor'
+
+
+def estimated_count(model, using):
+    """Planner row estimate of `model`'s table on Postgres, None elsewhere or before ANALYZE."""
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [model._meta.db_table])
+        row = cursor.fetchone()
+    # -1: never vacuumed/analyzed
+    return int(row[0]) if row and row[0] >= 0 else None
+
+
+def count_limit():
+    return getattr(settings, 'ADMIN_COUNT_LIMIT', 10000)
+
+
+class EstimatedCountPaginator(Paginator):
+    estimated = False  # count is the planner estimate
+    capped = False     # count stopped at count_limit() + 1
+
+    @cached_property
+    def count(self):
+        qs = self.object_list
+        limit = count_limit()
+        if not qs.query.has_filters():
+            estimate = estimated_count(qs.model, qs.db)
+            # small tables: the exact count is cheap and the estimate is coarse
+            if estimate is not None and estimate > limit:
+                self.estimated = True
+                return estimate
+        count = qs.order_by()[:limit + 1].count()
+        self.capped = count > limit
+        return count
+
+    @property
+    def count_display(self):
+        """The count as shown in the changelist: "10000+", "~123456" or exact."""
+        count = self.count
+        if self.capped:
+            return f'{count_limit()}+'
+        return f'~{count}' if self.estimated else str(count)
+
+
+class CursorChangeList(ChangeList):
+    def __init__(self, request, *args, **kwargs):
+        # needed by get_results(), which runs inside ChangeList.__init__
+        self.cursor_mode = ORDER_VAR not in request.GET
+        try:
+            self.cursor = int(request.GET[CURSOR_VAR])
+        except (KeyError, ValueError):
+            self.cursor = None
+        self.next_cursor = None
+        super().__init__(request, *args, **kwargs)
+        # the search form re-submits self.params as hidden fields
+        self.params.pop(CURSOR_VAR, None)
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_query_string(self, new_params=None, remove=None):
+        # changing filters/search/sorting starts from the first page again
+        return super().get_query_string(new_params, [CURSOR_VAR, *(remove or [])])
+
+    def get_results(self, request):
+        if not self.cursor_mode:
+            return super().get_results(request)
+
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        qs = self.queryset if self.cursor is None else self.queryset.filter(pk__lt=self.cursor)
+        rows = list(qs[:self.list_per_page + 1])
+        result_list = rows[:self.list_per_page]
+        if len(rows) > self.list_per_page:
+            self.next_cursor = result_list[-1].pk
+
+        self.result_count = paginator.count
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = result_list
+        self.can_show_all = False
+        self.multi_page = self.cursor is not None or self.next_cursor is not None
+        self.paginator = paginator
+
+    @property
+    def first_page_url(self):
+        return self.get_query_string()
+
+    @property
+    def next_page_url(self):
+        return self.get_query_string({CURSOR_VAR: self.next_cursor})
+
+
+class LargeTableAdminMixin:
+    """ModelAdmin settings for tables too big for exact counts and OFFSET paging."""
+    ordering = ('-pk',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    change_list_template = 'admin/catalog/large_change_list.html'
+
+    def get_changelist(self, request, **kwargs):
+        return CursorChangeList
@@ -0,0 +1,82 @@
+"""
+Per-sync diffs for the catalog change feed (CatalogChange).
+
+A sync snapshots the live titles of a platform/type before and after it runs
+(`capture`, two streamed queries each) and `record` compares the two snapshots with
+set operations over tmdb_ids: added, removed, popularity changed, metadata changed.
+Snapshots keep a hash of each title's metadata rather than the fields themselves, so
+they stay small next to the titles (descriptions) they describe.
+
+Readers page through the feed by id (`?since=<last id>`), which is only safe if ids
+become visible in order. Concurrent syncs could commit a lower id after a reader
+already moved past it, so `record` serializes the feed's writers: on Postgres the
+table is locked (EXCLUSIVE: reads go on) for the insert transaction; SQLite already
+allows a single writer at a time.
+"""
+from django.db import connections, router, transaction
+
+from . import metrics
+from .models import CatalogChange, Title
+
+
+def capture(platform, t_type):
+    """
+    {tmdb_id: (title, popularity, metadata hash)} of the live titles of platform/type.
+    Hashes are only comparable within one process (str hashing is salted per process).
+    """
+    live = Title.objects.live().filter(platform=platform, type=t_type).exclude(tmdb_id=None)
+    genres = {}
+    links = (Title.genres.through.objects.filter(title__in=live)
+             .order_by('title__tmdb_id', 'genre_id').values_list('title__tmdb_id', 'genre_id'))
+    for tmdb_id, genre_id in links.iterator():
+        genres[tmdb_id] = hash((genres.get(tmdb_id), genre_id))
+
+    state = {}
+    for tmdb_id, title, popularity, description, regions, poster_path in live.values_list(
+            'tmdb_id', 'title', 'popularity', 'description', 'regions', 'poster_path').iterator():
+        metadata = hash((title, description, regions, poster_path, genres.get(tmdb_id)))
+        state[tmdb_id] = (title, popularity, metadata)
+    return state
+
+
+def diff(before, after):
+    """(added, removed, popularity_changed, metadata_changed) tmdb_id sets."""
+    added = after.keys() - before.keys()
+    removed = before.keys() - after.keys()
+    common = before.keys() & after.keys()
+    popularity_changed = {i for i in common if before[i][1] != after[i][1]}
+    metadata_changed = {i for i in common if before[i][2] != after[i][2]}
+    return added, removed, popularity_changed, metadata_changed
+
+
+def record(platform, t_type, before, after):
+    """Append the diff between two `capture` snapshots to the feed. Returns the new rows."""
+    added, removed, popularity_changed, metadata_changed = diff(before, after)
+    rows = []
+    for change, ids in ((CatalogChange.ADDED, added), (CatalogChange.REMOVED, removed),
+                        (CatalogChange.POPULARITY, popularity_changed), (CatalogChange.METADATA, metadata_changed)):
+        for tmdb_id in sorted(ids):
+            old, new = before.get(tmdb_id), after.get(tmdb_id)
+            rows.append(CatalogChange(
+                platform=platform, type=t_type, tmdb_id=tmdb_id, change=change,
+                title=(new or old)[0],
+                popularity=new[1] if new else None,
+                previous_popularity=old[1] if old else None,
+            ))
+        if ids:
+            metrics.inc('catalog_changes_total', len(ids), change=change)
+    if not rows:
+        return []
+    using = router.db_for_write(CatalogChange)
+    # one transaction per sync: a reader never sees half of a diff
+    with transaction.atomic(using=using):
+        _lock_feed(using)
+        return CatalogChange.objects.using(using).bulk_create(rows)
+
+
+def _lock_feed(using):
+    """Hold the feed's writer lock until the current transaction ends."""
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(f'LOCK TABLE {connection.ops.quote_name(CatalogChange._meta.db_table)} IN EXCLUSIVE MODE')
@@ -0,0 +1,80 @@
+"""
+Page-level checkpoints for TMDB syncs (SyncCheckpoint).
+
+`catalog.pipeline` advances the checkpoint in the same transaction as each page's
+titles and keeps the partial JSON snapshot on disk when a sync fails. A sync run
+with `resume=True` then continues after the last completed page, in the same
+generation, appending to the partial snapshot from the recorded byte offset.
+
+A checkpoint is not resumed when TMDB now reports a materially different number
+of pages (more than TMDB_CHECKPOINT_PAGE_DRIFT, as a fraction), or when its staged
+titles or partial snapshot are gone.
+"""
+from django.conf import settings
+from django.db.models import F
+
+from . import tmdb
+from .models import SyncCheckpoint, Title
+
+
+def partial_snapshot_path(platform, kind):
+    return tmdb.snapshot_dir() / f".{platform.slug}-{kind}.json.partial"
+
+
+def start(platform, kind, op, generation):
+    """A fresh checkpoint for a new run (replacing any previous one)."""
+    checkpoint, _ = SyncCheckpoint.objects.update_or_create(
+        platform=platform, kind=kind,
+        defaults={
+            'op': op, 'generation': generation, 'total_pages': 0, 'completed_pages': 0,
+            'items_ingested': 0, 'created_count': 0, 'snapshot_offset': 0, 'finished': False,
+        },
+    )
+    return checkpoint
+
+
+def _materially_changed(old_total, new_total):
+    drift = getattr(settings, 'TMDB_CHECKPOINT_PAGE_DRIFT', 0.05)
+    return abs(new_total - old_total) > old_total * drift
+
+
+def resumable(platform, kind, op):
+    """The unfinished checkpoint of `op` for platform/kind if it can still be resumed, else None."""
+    checkpoint = SyncCheckpoint.objects.filter(platform=platform, kind=kind, op=op, finished=False).first()
+    if checkpoint is None or not checkpoint.completed_pages:
+        return None
+
+    partial = partial_snapshot_path(platform, kind)
+    if not partial.exists() or partial.stat().st_size < checkpoint.snapshot_offset:
+        return None
+    if op == SyncCheckpoint.GENERATE:
+        # the staged generation must still be there (a later sync may have collected it)
+        staged = Title.objects.filter(platform=platform, type=tmdb._title_type(kind), generation=checkpoint.generation,
+                                      is_live=False).count()
+        if staged != checkpoint.created_count:
+            return None
+    total_pages, _ = tmdb.get_total_pages(platform.tmdb_provider_id, kind=kind)
+    if _materially_changed(checkpoint.total_pages, total_pages):
+        return None
+    return checkpoint
+
+
+def advance(checkpoint, page, total_pages, items, created, snapshot_offset):
+    """Record one more completed page (call inside the transaction that wrote its titles)."""
+    SyncCheckpoint.objects.filter(pk=checkpoint.pk).update(
+        completed_pages=page,
+        total_pages=total_pages,
+        items_ingested=F('items_ingested') + items,
+        created_count=F('created_count') + created,
+        snapshot_offset=snapshot_offset,
+    )
+    checkpoint.completed_pages = page
+    checkpoint.total_pages = total_pages
+    checkpoint.items_ingested += items
+    checkpoint.created_count += created
+    checkpoint.snapshot_offset = snapshot_offset
+
+
+def finish(checkpoint):
+    SyncCheckpoint.objects.filter(pk=checkpoint.pk).update(finished=True)
+    checkpoint.finished = True
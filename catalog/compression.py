@@ -0,0 +1,58 @@
+"""
+Content-negotiated compression of the dynamic catalog responses.
+
+Brotli is used when the `brotli` package is installed and the client accepts it,
+gzip otherwise. Levels are tuned for per-request compression (see COMPRESSION_*
+settings and `manage.py bench_compression`), not the maximum used for the
+pre-rendered files.
+"""
+import gzip
+import re
+
+from django.conf import settings
+
+try:
+    import brotli
+except ImportError:  # optional
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript')
+_CODING_RE = re.compile(r'^\s*([a-zA-Z*-]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?\s*$')
+
+
+def available_encodings():
+    """Supported encodings, preferred first."""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate(accept_encoding):
+    """Best encoding allowed by an Accept-Encoding header, or None."""
+    qualities = {}
+    for part in (accept_encoding or '').split(','):
+        match = _CODING_RE.match(part)
+        if not match:
+            continue
+        try:
+            qualities[match.group(1).lower()] = float(match.group(2) or 1)
+        except ValueError:
+            continue
+    best = None
+    for encoding in available_encodings():
+        q = qualities.get(encoding, qualities.get('*', 0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (encoding, q)
+    return best[0] if best else None
+
+
+def compress(data, encoding, level=None):
+    if encoding == 'br':
+        quality = getattr(settings, 'COMPRESSION_BROTLI_QUALITY', 5) if level is None else level
+        return brotli.compress(data, quality=quality)
+    level = getattr(settings, 'COMPRESSION_GZIP_LEVEL', 6) if level is None else level
+    # mtime=0: identical content gives identical bytes
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def is_compressible(response):
+    content_type = response.get('Content-Type', '').split(';')[0].strip()
+    return content_type.startswith(COMPRESSIBLE_TYPES)
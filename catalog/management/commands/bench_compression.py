@@ -0,0 +1,62 @@
+import time
+
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand, CommandError
+from django.template import engines
+from django.test import RequestFactory, override_settings
+from django.urls import reverse
+
+from catalog import compression, views
+from catalog.models import Title
+
+
+class Command(BaseCommand):
+    help = 'Compare bytes on the wire and compression CPU for typical catalog responses'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50, help='Compressions timed per level')
+
+    def _pages(self):
+        title = Title.objects.live().select_related('platform').first()
+        if title is None:
+            raise CommandError('No titles: load some data first (loadsample or a TMDB sync)')
+        platform = title.platform
+        data_url = reverse('catalog:biblioteca_data', args=[platform.slug])
+        rf = RequestFactory()
+        return [
+            ('biblioteca_data x25', lambda: async_to_sync(views.biblioteca_data)(rf.get(data_url), slug=platform.slug)),
+            ('biblioteca_data x100', lambda: async_to_sync(views.biblioteca_data)(rf.get(data_url, {'page_size': 100}), slug=platform.slug)),
+            ('title_detail', lambda: async_to_sync(views.title_detail)(rf.get('/'), title_id=title.pk)),
+            ('biblioteca', lambda: views.biblioteca(rf.get(reverse('catalog:biblioteca')))),
+        ]
+
+    def _render(self, page, minify):
+        # fresh template cache so the loader runs with the wanted setting
+        with override_settings(TEMPLATE_MINIFY_PARTIALS=minify, SINGLEFLIGHT_ENABLED=False):
+            engines['django'].engine.template_loaders[0].reset()
+            content = page().content
+        engines['django'].engine.template_loaders[0].reset()
+        return content
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        levels = [('gzip', 1), ('gzip', 6), ('gzip', 9)]
+        if 'br' in compression.available_encodings():
+            levels += [('br', 1), ('br', 5), ('br', 11)]
+        else:
+            self.stdout.write('brotli not installed: gzip only')
+
+        self.stdout.write(f"{'page':<22}{'templates':<11}{'encoding':<10}{'bytes':>9}{'ratio':>8}{'cpu/op':>11}")
+        for name, page in self._pages():
+            for minify in (False, True):
+                content = self._render(page, minify)
+                variant = 'minified' if minify else 'raw'
+                self.stdout.write(f"{name:<22}{variant:<11}{'identity':<10}{len(content):>9}{1:>8.2f}{'-':>11}")
+                for encoding, level in levels:
+                    start = time.process_time()
+                    for _ in range(iterations):
+                        compressed = compression.compress(content, encoding, level)
+                    cpu_us = (time.process_time() - start) / iterations * 1e6
+                    self.stdout.write(
+                        f"{'':<22}{'':<11}{f'{encoding}-{level}':<10}{len(compressed):>9}"
+                        f"{len(compressed) / len(content):>8.2f}{cpu_us:>9.0f}us")
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from catalog import similarity
+
+
+class Command(BaseCommand):
+    help = 'Build the "similar titles" index (incremental unless --full)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Recompute every row')
+
+    def handle(self, *args, **options):
+        if options['full']:
+            count = recomputed = similarity.build_index()
+        else:
+            count, recomputed = similarity.update_index()
+        self.stdout.write(self.style.SUCCESS(
+            f"{count} titles indexed ({recomputed} recomputed) in {similarity.index_path()}"))
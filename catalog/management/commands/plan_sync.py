@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from catalog.models import Platform
+from catalog import planner, tmdb
+
+
+class Command(BaseCommand):
+    help = 'Plan (and with --execute, run) the TMDB discovery of platforms x regions x kinds'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--region', action='append', dest='regions', help='Watch region (repeatable). Default: TMDB_SYNC_REGIONS')
+        parser.add_argument('--kind', action='append', dest='kinds', choices=['movies', 'series'], help='Default: both')
+        parser.add_argument('--platform', action='append', dest='platforms', help='Platform slug (repeatable). Default: all with a provider id')
+        parser.add_argument('--execute', action='store_true', help='Run the plan and replace the platforms\' titles with its results')
+
+    def handle(self, *args, **options):
+        regions = options['regions'] or tmdb.sync_regions()
+        kinds = options['kinds'] or ['movies', 'series']
+        platforms = Platform.objects.exclude(tmdb_provider_id=None)
+        if options['platforms']:
+            platforms = platforms.filter(slug__in=options['platforms'])
+        platforms = list(platforms)
+        if not platforms:
+            raise CommandError('No platforms with tmdb_provider_id')
+
+        if not options['execute']:
+            targets = [(p.tmdb_provider_id, r, k) for p in platforms for r in regions for k in kinds]
+            self.stdout.write(planner.build_plan(targets).summary())
+            return
+
+        plan, created, requests = tmdb.generate_planned(platforms, kinds=kinds, regions=regions)
+        self.stdout.write(plan.summary())
+        for (slug, kind), count in sorted(created.items()):
+            self.stdout.write(f"{slug} {kind}: {count} titles")
+        self.stdout.write(f"requests made={requests} naive={plan.naive_requests}")
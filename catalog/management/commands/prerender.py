@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from catalog import prerender
+
+
+class Command(BaseCommand):
+    help = 'Write the pre-rendered library pages to PRERENDER_ROOT (run after deploys)'
+
+    def handle(self, *args, **options):
+        count = prerender.prerender_all()
+        self.stdout.write(self.style.SUCCESS(f"{count} files written to {prerender.prerender_root()}"))
@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+from catalog import metrics
+
+
+class Command(BaseCommand):
+    help = 'Show TMDB sync throughput, stage timings and cache effectiveness (see catalog.metrics)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prometheus', action='store_true', help='Print the raw /metrics exposition instead')
+
+    def handle(self, *args, **options):
+        if options['prometheus']:
+            self.stdout.write(metrics.render_prometheus())
+            return
+
+        counters, histograms = metrics.collect()
+        n = len(metrics.BUCKETS)
+
+        def counter(name, **labels):
+            want = set((k, str(v)) for k, v in labels.items())
+            return sum(v for (cname, l), v in counters.items() if cname == name and want <= set(l))
+
+        def hist(name, **labels):
+            want = set((k, str(v)) for k, v in labels.items())
+            count = total = 0
+            for (hname, l), h in histograms.items():
+                if hname == name and want <= set(l):
+                    count += h[n]
+                    total += h[n + 1]
+            return count, total
+
+        sync_count, sync_seconds = hist('tmdb_sync_seconds')
+        self.stdout.write(f"Syncs: {sync_count} ({sync_seconds:.1f}s)")
+        for kind in ('movies', 'series'):
+            pages = counter('tmdb_pages_total', kind=kind)
+            items = counter('tmdb_items_total', kind=kind)
+            self.stdout.write(f"  {kind}: {pages:g} pages, {items:g} items")
+        if sync_seconds:
+            pages = counter('tmdb_pages_total')
+            items = counter('tmdb_items_total')
+            self.stdout.write(f"  throughput: {pages / sync_seconds:.2f} pages/s, {items / sync_seconds:.1f} items/s")
+        self.stdout.write(f"  TMDB requests: {counter('tmdb_requests_total'):g}, rate limited (429): {counter('tmdb_rate_limited_total'):g}")
+
+        self.stdout.write('Stages:')
+        for stage in ('fetch', 'parse', 'upsert', 'snapshot'):
+            count, total = hist('tmdb_stage_seconds', stage=stage)
+            mean = total / count if count else 0
+            self.stdout.write(f"  {stage}: {count} x, {total:.2f}s total, {mean * 1000:.1f}ms mean")
+
+        caches = sorted({dict(l).get('cache') for (name, l) in counters if name == 'cache_requests_total'})
+        if caches:
+            self.stdout.write('Caches:')
+        for cache_name in caches:
+            hits = counter('cache_requests_total', cache=cache_name, result='hit')
+            misses = counter('cache_requests_total', cache=cache_name, result='miss')
+            rate = hits / (hits + misses) * 100 if hits + misses else 0
+            self.stdout.write(f"  {cache_name}: {hits:g} hits, {misses:g} misses ({rate:.0f}% hit rate)")
@@ -0,0 +1,47 @@
+import json
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from catalog import posters, tmdb
+
+
+class Command(BaseCommand):
+    help = 'Pre-fill the local poster cache (POSTER_CACHE_DIR) from the data/*.json snapshots'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', action='append', dest='sizes', choices=posters.POSTER_SIZES, help='Poster size (repeatable). Default: w92, w154')
+        parser.add_argument('--limit', type=int, default=0, help='Only the N most popular titles of each snapshot')
+
+    def handle(self, *args, **options):
+        if posters.cache_dir() is None:
+            raise CommandError('POSTER_CACHE_DIR is not set')
+        sizes = options['sizes'] or ['w92', 'w154']
+
+        names = {}
+        for fname in sorted(tmdb.snapshot_dir().glob('*.json')):
+            with open(fname, encoding='utf-8') as fh:
+                items = json.load(fh)
+            if not isinstance(items, list):
+                continue
+            items = sorted(items, key=lambda it: it.get('popularity') or 0, reverse=True)
+            if options['limit']:
+                items = items[:options['limit']]
+            for it in items:
+                if it.get('poster_path'):
+                    names[it['poster_path'].lstrip('/')] = None
+
+        downloaded = cached = failed = 0
+        with requests.Session() as session:
+            for name in names:
+                for size in sizes:
+                    try:
+                        _, was_downloaded = posters.fetch_to_cache(size, name, session=session)
+                    except (ValueError, requests.RequestException) as e:
+                        failed += 1
+                        self.stderr.write(f"{size}/{name}: {e}")
+                        continue
+                    if was_downloaded:
+                        downloaded += 1
+                    else:
+                        cached += 1
+        self.stdout.write(self.style.SUCCESS(f"{len(names)} posters: {downloaded} downloaded, {cached} already cached, {failed} failed"))
@@ -0,0 +1,286 @@
+"""
+Minimal counters and histograms with a Prometheus text export.
+
+Each process keeps its samples in memory. When settings.METRICS_DIR is set (it is
+by default), every process also dumps them to METRICS_DIR/<pid>-<token>.json (at
+most every METRICS_FLUSH_INTERVAL seconds, from a background thread so requests
+never wait on the disk) and `collect()` sums all the files, so /metrics shows totals
+across gunicorn/uvicorn workers and management commands. The random token keeps a
+new process that reuses a pid from overwriting a dead one's file.
+
+Counters and histograms only ever grow, so the samples of dead workers still count:
+`collect()` folds their files into METRICS_DIR/retired.json (under a file lock, one
+collector at a time) and deletes them, so a scrape reads one file per live process
+plus one. This assumes the directory is shared by processes of one host (pids).
+"""
+import asyncio
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+
+from django.conf import settings
+
+# histogram upper bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [count per bucket..., +Inf count, sum]
+_last_flush = 0.0  # guarded by _lock
+# serializes writes of this process' file
+_flush_lock = threading.Lock()
+_file_id = None  # (pid, file name)
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    _maybe_flush()
+
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                h[i] += 1
+        h[len(BUCKETS)] += 1
+        h[len(BUCKETS) + 1] += seconds
+    _maybe_flush()
+
+
+@contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name, **labels):
+    """Decorator recording the duration of a (sync or async) function in histogram `name`."""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with timer(name, **labels):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _snapshot():
+    with _lock:
+        return {
+            'counters': [[n, list(l), v] for (n, l), v in _counters.items()],
+            'histograms': [[n, list(l), list(h)] for (n, l), h in _histograms.items()],
+        }
+
+
+def _metrics_dir():
+    path = getattr(settings, 'METRICS_DIR', None)
+    return Path(path) if path else None
+
+
+def _process_file(outdir):
+    global _file_id
+    pid = os.getpid()
+    if _file_id is None or _file_id[0] != pid:  # first flush, or a forked child
+        _file_id = (pid, f"{pid}-{uuid.uuid4().hex[:8]}.json")
+    return outdir / _file_id[1]
+
+
+def _claim_flush(force):
+    """True when this caller should flush now (at most one caller per interval)."""
+    global _last_flush
+    now = time.monotonic()
+    with _lock:
+        if not force and now - _last_flush < getattr(settings, 'METRICS_FLUSH_INTERVAL', 5):
+            return False
+        _last_flush = now
+        return True
+
+
+def _write_json(path, data):
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=path.parent, prefix='.', suffix='.tmp',
+                                     delete=False) as fh:
+        try:
+            json.dump(data, fh)
+        except BaseException:
+            fh.close()
+            os.unlink(fh.name)
+            raise
+    os.replace(fh.name, path)
+
+
+def _write(outdir):
+    with _flush_lock:
+        outdir.mkdir(parents=True, exist_ok=True)
+        _write_json(_process_file(outdir), _snapshot())
+
+
+def flush(force=False):
+    """Write this process' samples to METRICS_DIR (no-op when it is not configured)."""
+    outdir = _metrics_dir()
+    if outdir is not None and _claim_flush(force):
+        _write(outdir)
+
+
+def _flush_in_thread(outdir):
+    try:
+        _write(outdir)
+    except OSError:
+        # metrics must never break anything
+        pass
+
+
+def _maybe_flush():
+    outdir = _metrics_dir()
+    if outdir is not None and _claim_flush(False):
+        threading.Thread(target=_flush_in_thread, args=(outdir,), name='metrics-flush', daemon=True).start()
+
+
+RETIRED_FILE = 'retired.json'
+
+
+def _read(fname):
+    try:
+        with open(fname, encoding='utf-8') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _sum(snapshots):
+    counters = {}
+    histograms = {}
+    for snap in snapshots:
+        for name, labels, value in snap['counters']:
+            key = (name, tuple(tuple(x) for x in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, h in snap['histograms']:
+            key = (name, tuple(tuple(x) for x in labels))
+            acc = histograms.setdefault(key, [0] * (len(BUCKETS) + 2))
+            for i, v in enumerate(h):
+                acc[i] += v
+    return counters, histograms
+
+
+def _retire_dead_files(outdir):
+    """Fold the files of processes that are gone into RETIRED_FILE and delete them."""
+    dead = []
+    for fname in outdir.glob('*.json'):
+        pid = fname.stem.split('-')[0]
+        if pid.isdigit() and int(pid) != os.getpid() and not _alive(int(pid)):
+            dead.append(fname)
+    if not dead:
+        return
+    with open(outdir / '.retire.lock', 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return  # another collector is at it
+        retired = _read(outdir / RETIRED_FILE) or {'counters': [], 'histograms': [], 'merged': []}
+        already = set(retired.get('merged', ()))
+        snapshots, merged = [retired], []
+        for fname in dead:
+            # names listed in `merged` were folded in but not deleted yet
+            snap = None if fname.name in already else _read(fname)
+            if snap is not None:
+                snapshots.append(snap)
+            if snap is not None or fname.name in already:
+                merged.append(fname.name)
+        counters, histograms = _sum(snapshots)
+        _write_json(outdir / RETIRED_FILE, {
+            'counters': [[n, [list(x) for x in l], v] for (n, l), v in counters.items()],
+            'histograms': [[n, [list(x) for x in l], h] for (n, l), h in histograms.items()],
+            'merged': merged,
+        })
+        for name in merged:
+            (outdir / name).unlink(missing_ok=True)
+
+
+def collect():
+    """Return (counters, histograms) summed over every process."""
+    outdir = _metrics_dir()
+    if outdir is None:
+        return _sum([_snapshot()])
+
+    flush(force=True)
+    try:
+        _retire_dead_files(outdir)
+    except OSError:
+        pass
+    files = {fname.name: _read(fname) for fname in outdir.glob('*.json')}
+    retired = files.get(RETIRED_FILE) or {}
+    # already counted in retired.json
+    for name in retired.get('merged', ()):
+        files.pop(name, None)
+    return _sum(snap for snap in files.values() if snap is not None)
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+def render_prometheus():
+    counters, histograms = collect()
+    lines = []
+    for name in sorted({n for n, _ in counters}):
+        lines.append(f'# TYPE {name} counter')
+        for (n, labels), value in sorted(counters.items()):
+            if n == name:
+                lines.append(f'{name}{_format_labels(labels)} {value:g}')
+    for name in sorted({n for n, _ in histograms}):
+        lines.append(f'# TYPE {name} histogram')
+        for (n, labels), h in sorted(histograms.items()):
+            if n != name:
+                continue
+            for bound, count in zip(BUCKETS, h):
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", f"{bound:g}")])} {count}')
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {h[len(BUCKETS)]}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {h[len(BUCKETS) + 1]:g}')
+            lines.append(f'{name}_count{_format_labels(labels)} {h[len(BUCKETS)]}')
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """Forget this process' samples (tests)."""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
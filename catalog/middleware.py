@@ -0,0 +1,136 @@
+import re
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+from whitenoise.middleware import WhiteNoiseMiddleware
+from whitenoise.responders import MissingFileError
+
+from . import compression, metrics, prerender
+from .routers import use_primary
+
+
+class PrimaryDatabaseForAdminMiddleware:
+    """
+    Admin requests read and write on the primary so staff always see their own
+    changes, regardless of replica lag.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def _is_admin(self, request):
+        return request.path.startswith('/admin/')
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self._is_admin(request):
+            return self.get_response(request)
+        with use_primary():
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        if not self._is_admin(request):
+            return await self.get_response(request)
+        with use_primary():
+            return await self.get_response(request)
+
+
+class PrerenderedWhiteNoiseMiddleware(WhiteNoiseMiddleware):
+    """
+    WhiteNoise that also serves the pre-rendered library pages written by
+    catalog.prerender (with their .gz/.br variants) before falling back to the views.
+
+    Async-capable: under ASGI the files are streamed in chunks read off the event
+    loop instead of running the whole response in a sync worker thread.
+    """
+    sync_capable = True
+    async_capable = True
+    # bytes read per executor hop when streaming under ASGI
+    async_block_size = 64 * 1024
+
+    def __init__(self, get_response=None, settings=settings):
+        super().__init__(get_response, settings=settings)
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def _find(self, request):
+        """Pre-rendered page or static file answering `request`, or None."""
+        path = prerender.path_for_request(request)
+        if path is not None:
+            try:
+                static_file = self.get_static_file(str(path), request.path_info)
+            except MissingFileError:
+                metrics.inc('cache_requests_total', cache='prerender', result='miss')
+            else:
+                metrics.inc('cache_requests_total', cache='prerender', result='hit')
+                return static_file
+        if self.autorefresh:
+            return self.find_file(request.path_info)
+        return self.files.get(request.path_info)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        static_file = self._find(request)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        # lookups are dict hits and a stat(), cheap enough to run on the loop
+        static_file = self._find(request)
+        if static_file is None:
+            return await self.get_response(request)
+        response = self.serve(static_file, request)
+        if response.file_to_stream is not None:
+            # the file stays registered in the response's closers
+            response.streaming_content = _aread(response.file_to_stream, self.async_block_size)
+        return response
+
+
+async def _aread(filelike, block_size):
+    read = sync_to_async(filelike.read, thread_sensitive=False)
+    while chunk := await read(block_size):
+        yield chunk
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """
+    Brotli/gzip compression (see catalog.compression) of the dynamic catalog views'
+    responses of at least settings.COMPRESSION_MIN_SIZE bytes. Static files and the
+    pre-rendered pages are already served compressed by WhiteNoise.
+    """
+
+    def process_response(self, request, response):
+        match = getattr(request, 'resolver_match', None)
+        if (not getattr(settings, 'COMPRESSION_ENABLED', True) or match is None or match.app_name != 'catalog'
+                or response.streaming or response.has_header('Content-Encoding')
+                or not compression.is_compressible(response)):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        content = response.content
+        if len(content) < getattr(settings, 'COMPRESSION_MIN_SIZE', 1024):
+            return response
+        encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return response
+        compressed = compression.compress(content, encoding)
+        if len(compressed) >= len(content):
+            return response
+
+        metrics.inc('response_bytes_total', len(content), encoding='identity')
+        metrics.inc('response_bytes_total', len(compressed), encoding=encoding)
+        response.content = compressed
+        response['Content-Length'] = str(len(compressed))
+        response['Content-Encoding'] = encoding
+        if response.has_header('ETag'):
+            response['ETag'] = re.sub(r'^"', 'W/"', response['ETag'])
+        return response
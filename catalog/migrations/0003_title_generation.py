@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0002_platform_tmdb_provider_id_title_tmdb_id_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='title',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='title',
+            name='generation',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='title',
+            name='is_live',
+            field=models.BooleanField(db_index=True, default=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='title',
+            unique_together={('platform', 'tmdb_id', 'generation')},
+        ),
+    ]
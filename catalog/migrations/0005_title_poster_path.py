@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:00
+
+from django.db import migrations, models
+
+TMDB_IMAGE_PREFIX = 'https://image.tmdb.org/t/p/'
+
+
+def move_tmdb_urls_to_path(apps, schema_editor):
+    Title = apps.get_model('catalog', 'Title')
+    for t in Title.objects.filter(poster_url__startswith=TMDB_IMAGE_PREFIX).only('pk', 'poster_url').iterator():
+        # https://image.tmdb.org/t/p/w300/abc.jpg -> /abc.jpg
+        path = '/' + t.poster_url[len(TMDB_IMAGE_PREFIX):].split('/', 1)[-1]
+        Title.objects.filter(pk=t.pk).update(poster_path=path, poster_url='')
+
+
+def path_back_to_url(apps, schema_editor):
+    Title = apps.get_model('catalog', 'Title')
+    for t in Title.objects.exclude(poster_path='').only('pk', 'poster_path').iterator():
+        Title.objects.filter(pk=t.pk).update(poster_url=f"{TMDB_IMAGE_PREFIX}w300{t.poster_path}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0004_tmdbreference'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='title',
+            name='poster_path',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.RunPython(move_tmdb_urls_to_path, path_back_to_url),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0005_title_poster_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(choices=[('movie', 'Película'), ('series', 'Serie')], max_length=10)),
+                ('tmdb_id', models.IntegerField()),
+                ('change', models.CharField(choices=[('added', 'Nuevo'), ('removed', 'Eliminado'), ('popularity', 'Popularidad'), ('metadata', 'Datos')], max_length=10)),
+                ('title', models.CharField(max_length=255)),
+                ('popularity', models.IntegerField(blank=True, null=True)),
+                ('previous_popularity', models.IntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('platform', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='changes', to='catalog.platform')),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['platform', 'change', '-id'], name='catalog_cat_platfor_0b47de_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+import catalog.models
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0006_catalogchange'),
+    ]
+
+    operations = [
+        # skipped when the extension is already installed (e.g. by a DBA: installing it
+        # needs CREATE privilege on the database, superuser before Postgres 13)
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name='title',
+            index=catalog.models.UpperTrigramIndex('title', name='catalog_title_title_trgm'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:16
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0007_title_search_trgm_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=10)),
+                ('op', models.CharField(choices=[('generate', 'Generate'), ('update', 'Update')], max_length=10)),
+                ('generation', models.PositiveIntegerField()),
+                ('total_pages', models.PositiveIntegerField(default=0)),
+                ('completed_pages', models.PositiveIntegerField(default=0)),
+                ('items_ingested', models.PositiveIntegerField(default=0)),
+                ('created_count', models.PositiveIntegerField(default=0)),
+                ('snapshot_offset', models.PositiveBigIntegerField(default=0)),
+                ('finished', models.BooleanField(default=False)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('platform', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_checkpoints', to='catalog.platform')),
+            ],
+            options={
+                'unique_together': {('platform', 'kind')},
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:23
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0008_synccheckpoint'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='title',
+            unique_together={('platform', 'type', 'tmdb_id', 'generation')},
+        ),
+    ]
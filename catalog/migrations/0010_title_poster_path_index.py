@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0009_title_unique_per_type'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='title',
+            name='poster_path',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+    ]
@@ -1,7 +1,31 @@
+from django.contrib.postgres.indexes import GinIndex, OpClass
 from django.db import models
+from django.db.models.functions import Upper
 from django.utils.text import slugify
 
 
+class UpperTrigramIndex(GinIndex):
+    """
+    pg_trgm GIN index on UPPER(field): Django's icontains compares UPPER("field"::text),
+    so admin searches use it instead of scanning the table. Other databases (SQLite in
+    development and tests) have neither GIN nor operator classes and get a plain
+    expression index.
+    """
+
+    def __init__(self, field, *, name):
+        super().__init__(OpClass(Upper(field), name='gin_trgm_ops'), name=name)
+        self.field = field
+
+    def deconstruct(self):
+        path, _, kwargs = super().deconstruct()
+        return path, (self.field,), {'name': kwargs['name']}
+
+    def create_sql(self, model, schema_editor, using='', **kwargs):
+        if schema_editor.connection.vendor != 'postgresql':
+            return models.Index(Upper(self.field), name=self.name).create_sql(model, schema_editor, using=using, **kwargs)
+        return super().create_sql(model, schema_editor, using=using, **kwargs)
+
+
 class Platform(models.Model):
     name = models.CharField(max_length=100)
     slug = models.SlugField(max_length=120, unique=True)
@@ -26,6 +50,12 @@ class Genre(models.Model):
         return self.name
 
 
+class TitleQuerySet(models.QuerySet):
+    def live(self):
+        """Titles of the active generation (excludes rows staged by an in-progress sync)."""
+        return self.filter(is_live=True)
+
+
 class Title(models.Model):
     TYPE_CHOICES = (
         ('movie', 'Película'),
@@ -39,11 +69,21 @@ class Title(models.Model):
     genres = models.ManyToManyField(Genre, blank=True)
     popularity = models.IntegerField(default=0)
     description = models.TextField(blank=True)
+    # full URL for posters hosted elsewhere; TMDB posters only keep poster_path and the
+    # templates build sized URLs from it (see catalog.posters)
     poster_url = models.URLField(blank=True)
+    # indexed: the poster proxy only downloads posters that some title uses
+    poster_path = models.CharField(max_length=100, blank=True, db_index=True)
     # simple region code storage; include 'AR' for Argentina
     regions = models.CharField(max_length=200, default='AR')
     # TMDB id for the title (movie or tv). Use to avoid duplicates when syncing.
     tmdb_id = models.IntegerField(null=True, blank=True)
+    # TMDB syncs write a new generation with is_live=False and flip it live at the end,
+    # so readers never see a half-imported platform (see catalog.tmdb.generate_platform)
+    generation = models.PositiveIntegerField(default=0)
+    is_live = models.BooleanField(default=True, db_index=True)
+
+    objects = TitleQuerySet.as_manager()
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -58,4 +98,88 @@ class Title(models.Model):
         return f"{self.title} ({self.get_type_display()})"
 
     class Meta:
-        unique_together = (('platform', 'tmdb_id'),)
+        # movie and tv ids are separate TMDB ranges (they overlap) and each type numbers its generations
+        unique_together = (('platform', 'type', 'tmdb_id', 'generation'),)
+        # admin search (TitleAdmin.search_fields); needs the pg_trgm extension (migration 0007)
+        indexes = [UpperTrigramIndex('title', name='catalog_title_title_trgm')]
+
+
+class TMDBReference(models.Model):
+    """
+    Cached TMDB reference data (the genre lists, see catalog.reference).
+    `version` increases only when the fetched payload differs from the stored one.
+    """
+    key = models.CharField(max_length=50, unique=True)
+    data = models.JSONField(default=dict)
+    version = models.PositiveIntegerField(default=1)
+    fetched_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.key} v{self.version}"
+
+
+class CatalogChange(models.Model):
+    """
+    Append-only change feed: one row per title that a sync added, removed or changed.
+    The primary key is the feed's sequence number; clients ask for changes after the
+    last one they saw (`catalog:changes?since=<id>`). Writers are serialized
+    (catalog.changes.record) so ids become visible in order.
+    """
+    ADDED = 'added'
+    REMOVED = 'removed'
+    POPULARITY = 'popularity'
+    METADATA = 'metadata'
+    CHANGE_CHOICES = [
+        (ADDED, 'Nuevo'),
+        (REMOVED, 'Eliminado'),
+        (POPULARITY, 'Popularidad'),
+        (METADATA, 'Datos'),
+    ]
+
+    platform = models.ForeignKey(Platform, on_delete=models.CASCADE, related_name='changes')
+    type = models.CharField(max_length=10, choices=Title.TYPE_CHOICES)
+    tmdb_id = models.IntegerField()
+    change = models.CharField(max_length=10, choices=CHANGE_CHOICES)
+    title = models.CharField(max_length=255)
+    popularity = models.IntegerField(null=True, blank=True)
+    previous_popularity = models.IntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [models.Index(fields=['platform', 'change', '-id'])]
+
+    def __str__(self):
+        return f"#{self.pk} {self.change} {self.title}"
+
+
+class SyncCheckpoint(models.Model):
+    """
+    Progress of the last TMDB sync of a platform/kind (catalog.checkpoints). Updated in
+    the same transaction as each page's titles, so a sync that dies resumes after
+    `completed_pages` and repeats at most one page.
+    """
+    GENERATE = 'generate'
+    UPDATE = 'update'
+    OP_CHOICES = [(GENERATE, 'Generate'), (UPDATE, 'Update')]
+
+    platform = models.ForeignKey(Platform, on_delete=models.CASCADE, related_name='sync_checkpoints')
+    kind = models.CharField(max_length=10)
+    op = models.CharField(max_length=10, choices=OP_CHOICES)
+    # generation the sync writes into
+    generation = models.PositiveIntegerField()
+    total_pages = models.PositiveIntegerField(default=0)
+    completed_pages = models.PositiveIntegerField(default=0)
+    # ingest offsets: discover items processed, titles created, bytes of the partial snapshot
+    items_ingested = models.PositiveIntegerField(default=0)
+    created_count = models.PositiveIntegerField(default=0)
+    snapshot_offset = models.PositiveBigIntegerField(default=0)
+    finished = models.BooleanField(default=False)
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('platform', 'kind'),)
+
+    def __str__(self):
+        return f"{self.platform} {self.kind} {self.op}: {self.completed_pages}/{self.total_pages}"
@@ -0,0 +1,166 @@
+"""
+Streaming TMDB sync pipeline: fetch → normalize → batch upsert → snapshot append.
+
+A fetch thread downloads discover pages into a bounded queue while the calling
+thread (which owns the DB connection and the routing context) normalizes the items,
+upserts them in batches and appends them to the JSON snapshot. The pipeline holds at
+most TMDB_PIPELINE_QUEUE_PAGES pages plus one batch whatever the provider size (the
+change feed adds one small tuple per live title, see catalog.changes.capture), and
+DB writes overlap with the next network fetches. Batches are made of whole pages so
+that each one can be checkpointed (catalog.checkpoints).
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from . import checkpoints, metrics, tmdb
+
+_DONE = object()
+
+
+class _Failure:
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
+
+
+def fetch_pages(provider_id, kind, region=None, start_page=1):
+    """
+    Yield (page, total_pages, items) for start_page..total_pages. Pages are fetched
+    ahead by a background thread, at most TMDB_PIPELINE_QUEUE_PAGES of them.
+    `total_pages` is the one reported by the first fetched page.
+    """
+    pages = queue.Queue(maxsize=getattr(settings, 'TMDB_PIPELINE_QUEUE_PAGES', 4))
+    stop = threading.Event()
+    delay = getattr(settings, 'TMDB_REQUEST_DELAY', 0.25)
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                pages.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            page, total = start_page, None
+            while total is None or page <= total:
+                data = tmdb.discover_page(provider_id, kind=kind, page=page, region=region)
+                if total is None:
+                    total = int(data.get('total_pages', 1))
+                if page > total:
+                    break  # resumed after the last page
+                if not put((page, total, data.get('results', []))):
+                    return  # the consumer gave up
+                page += 1
+                if page <= total:
+                    time.sleep(delay)
+            put(_DONE)
+        except BaseException as exc:
+            put(_Failure(exc))
+
+    thread = threading.Thread(target=produce, name=f'tmdb-fetch-{provider_id}-{kind}', daemon=True)
+    thread.start()
+    try:
+        while True:
+            entry = pages.get()
+            if entry is _DONE:
+                return
+            if isinstance(entry, _Failure):
+                raise entry.error
+            yield entry
+    finally:
+        stop.set()
+
+
+def page_batches(pages, kind, batch_size, max_pages):
+    """
+    Normalize items and group whole pages into batches of about `batch_size` items
+    (at most `max_pages` pages). Yields (last page, total_pages, [(raw, record), ...]).
+    """
+    batch, count, last = [], 0, None
+    for page, total, items in pages:
+        tmdb._count_page(kind, items)
+        batch.extend((it, tmdb.normalize_item(it, kind)) for it in items)
+        count, last = count + 1, (page, total)
+        if len(batch) >= batch_size or count >= max_pages:
+            yield last[0], last[1], batch
+            batch, count = [], 0
+    if count:
+        yield last[0], last[1], batch
+
+
+class SnapshotWriter:
+    """
+    Writes the data/<slug>-<kind>.json snapshot one batch at a time into a partial
+    file, which replaces the previous snapshot once the sync completes. When the sync
+    fails the partial file stays for a resumed run, which continues writing at
+    `offset` (bytes, as recorded by the checkpoint).
+    """
+
+    def __init__(self, platform_slug, kind, partial_path, offset=0):
+        self.path = tmdb.snapshot_dir() / f"{platform_slug}-{kind}.json"
+        self.partial_path = partial_path
+        self._start_offset = offset
+        self._fh = None
+
+    def __enter__(self):
+        self.partial_path.parent.mkdir(parents=True, exist_ok=True)
+        if self._start_offset:
+            self._fh = open(self.partial_path, 'r+b')
+            self._fh.truncate(self._start_offset)
+            self._fh.seek(self._start_offset)
+        else:
+            self._fh = open(self.partial_path, 'wb')
+            self._fh.write(b'[')
+        return self
+
+    def extend(self, items):
+        for it in items:
+            # '[' alone means nothing was written yet
+            self._fh.write(b',\n  ' if self._fh.tell() > 1 else b'\n  ')
+            self._fh.write(json.dumps(it, ensure_ascii=False).encode('utf-8'))
+
+    def offset(self):
+        self._fh.flush()
+        return self._fh.tell()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self._fh.close()
+            return False
+        self._fh.write(b'\n]\n' if self._fh.tell() > 1 else b']\n')
+        self._fh.close()
+        os.replace(self.partial_path, self.path)
+        return False
+
+
+def run(platform, kind, upsert, checkpoint, region=None):
+    """
+    Stream the discover pages of `platform` after `checkpoint.completed_pages` through
+    `upsert(records)`, which writes one batch of normalized records and returns how
+    many titles it created. Each batch and the checkpoint are committed together.
+    Returns (snapshot path, titles created by the whole run, resumed parts included).
+    """
+    batch_size = getattr(settings, 'TMDB_INGEST_BATCH_SIZE', 500)
+    max_pages = getattr(settings, 'TMDB_CHECKPOINT_PAGES', 1)
+    partial = checkpoints.partial_snapshot_path(platform, kind)
+    with SnapshotWriter(platform.slug, kind, partial, offset=checkpoint.snapshot_offset) as snapshot:
+        pages = fetch_pages(platform.tmdb_provider_id, kind, region=region, start_page=checkpoint.completed_pages + 1)
+        for page, total, batch in page_batches(pages, kind, batch_size, max_pages):
+            with metrics.timer('tmdb_stage_seconds', stage='snapshot'):
+                snapshot.extend(it for it, _ in batch)
+                offset = snapshot.offset()
+            with metrics.timer('tmdb_stage_seconds', stage='upsert'), transaction.atomic():
+                created = upsert([record for _, record in batch])
+                checkpoints.advance(checkpoint, page, total, len(batch), created, offset)
+    checkpoints.finish(checkpoint)
+    return str(snapshot.path), checkpoint.created_count
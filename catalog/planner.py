@@ -0,0 +1,254 @@
+"""
+Request planner for TMDB discovery over many (provider, region, kind) targets.
+
+The naive approach crawls every target on its own: one discover query per
+provider and region, all pages. `build_plan` probes page 1 of every query it may
+need and `execute_plan` runs the plan, reusing those pages. `tmdb.generate_planned`
+(`manage.py plan_sync --execute`, the "all regions" admin action) ingests the
+result. The planner:
+
+- collapses duplicate targets (several platforms sharing a provider id),
+- leaves providers whose results fit on the probed page 1 alone: they are
+  complete already,
+- per (region, kind) group, decides whether to crawl the remaining providers
+  separately or all at once with TMDB's OR syntax (`with_watch_providers=8|337`).
+  Combined results carry no provider information, so they are attributed back with
+  one `watch/providers` lookup per unique title. Titles repeated across providers
+  and regions are deduplicated before those lookups, and one lookup answers every
+  region of that title. Lookups are therefore shared across the regions of a kind.
+  Combined groups are chosen per kind, when the pages they save over all regions
+  outweigh the lookups.
+
+`SyncPlan.summary()` reports the request count against the naive plan.
+"""
+import time
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+
+from . import tmdb
+
+# TMDB refuses discover pages beyond 500
+MAX_DISCOVER_PAGES = 500
+# watch/providers buckets a discover query matches (it filters on every monetization type)
+PROVIDER_BUCKETS = ('flatrate', 'free', 'ads', 'rent', 'buy')
+
+SyncTarget = namedtuple('SyncTarget', 'provider_id region kind')
+# titles: {(provider_id, kind): {tmdb_id: (discover item, regions)}}; requests: TMDB requests made
+PlanResult = namedtuple('PlanResult', 'titles requests')
+
+
+def _pages(data):
+    return min(int(data.get('total_pages') or 0), MAX_DISCOVER_PAGES)
+
+
+def _results(data):
+    return int(data.get('total_results') or 0) if data else 0
+
+
+class GroupPlan:
+    """Plan for one (region, kind): the probed first pages and the chosen strategy."""
+
+    def __init__(self, region, kind, first_pages, combined_first_page=None):
+        self.region = region
+        self.kind = kind
+        # provider_id -> discover page 1 for that provider alone
+        self.first_pages = first_pages
+        # page 1 of the OR query over `multi_page_ids`, when the group crawls them together
+        self.combined_first_page = combined_first_page
+
+    @property
+    def provider_ids(self):
+        return sorted(self.first_pages)
+
+    @property
+    def multi_page_ids(self):
+        """Providers with results beyond the probed page 1."""
+        return sorted(pid for pid, data in self.first_pages.items() if _pages(data) > 1)
+
+    @property
+    def split_requests(self):
+        return sum(max(_pages(d), 1) for d in self.first_pages.values())
+
+    @property
+    def combined_pages(self):
+        return max(_pages(self.combined_first_page), 1) if self.combined_first_page else None
+
+    @property
+    def combined_results(self):
+        return _results(self.combined_first_page) if self.combined_first_page else None
+
+    @property
+    def strategy(self):
+        return 'combined' if self.combined_first_page is not None else 'split'
+
+    @property
+    def crawl_requests(self):
+        """Discover requests of the chosen strategy, probes included."""
+        if self.strategy == 'split':
+            return self.split_requests
+        # the per-provider probes are spent either way
+        return len(self.first_pages) + self.combined_pages
+
+
+class SyncPlan:
+    def __init__(self, targets, groups, probe_requests):
+        self.targets = targets
+        self.groups = groups
+        # probes that are not reused as crawl pages (combined page 1 of split groups)
+        self.probe_requests = probe_requests
+
+    @property
+    def naive_requests(self):
+        # every target crawled alone, duplicates included
+        per_query = {}
+        for group in self.groups:
+            for pid, data in group.first_pages.items():
+                per_query[(pid, group.region, group.kind)] = max(_pages(data), 1)
+        return sum(per_query[t] for t in self.targets)
+
+    @property
+    def attribution_requests(self):
+        """
+        Estimated watch/providers lookups: the largest combined group of each kind,
+        assuming the other regions offer mostly the same titles. execute_plan reports
+        the actual count.
+        """
+        per_kind = defaultdict(int)
+        for group in self.groups:
+            if group.strategy == 'combined':
+                per_kind[group.kind] = max(per_kind[group.kind], group.combined_results)
+        return sum(per_kind.values())
+
+    @property
+    def planned_requests(self):
+        return self.probe_requests + sum(g.crawl_requests for g in self.groups) + self.attribution_requests
+
+    @property
+    def saved_requests(self):
+        return self.naive_requests - self.planned_requests
+
+    def summary(self):
+        lines = []
+        for g in self.groups:
+            combined = '-' if g.combined_pages is None else f"{g.combined_pages}+{g.combined_results} lookups"
+            lines.append(f"{g.kind}/{g.region} providers={','.join(map(str, g.provider_ids))} strategy={g.strategy} "
+                         f"split={g.split_requests} combined={combined}")
+        lines.append(f"naive={self.naive_requests} planned={self.planned_requests} saved={self.saved_requests}")
+        return '\n'.join(lines)
+
+
+def _choose_combined(candidates):
+    """
+    Groups of one kind (with their OR page 1 probed) to crawl combined. Lookups are
+    shared by all regions, so for each size of the largest combined group take every
+    group that saves pages, and keep the best total.
+    """
+    def saving(g):
+        # split: each provider's pages; combined: their probes plus the OR query's pages
+        return sum(_pages(g.first_pages[pid]) - 1 for pid in g.multi_page_ids) - max(_pages(g.combined_first_page), 1)
+
+    best, best_net = [], 0
+    for limit in sorted({_results(g.combined_first_page) for g in candidates}):
+        chosen = [g for g in candidates if _results(g.combined_first_page) <= limit and saving(g) > 0]
+        net = sum(saving(g) for g in chosen) - limit
+        if net > best_net:
+            best, best_net = chosen, net
+    return best
+
+
+def build_plan(targets):
+    """
+    Probe TMDB and build a SyncPlan for an iterable of SyncTarget (or plain tuples).
+    Only page 1 of each query is requested here; those pages are reused by `execute_plan`.
+    """
+    targets = [SyncTarget(*t) for t in targets]
+    grouped = defaultdict(set)
+    for t in targets:
+        grouped[(t.region, t.kind)].add(t.provider_id)
+
+    groups = []
+    for (region, kind), provider_ids in sorted(grouped.items()):
+        first_pages = {pid: tmdb.discover_page(pid, kind=kind, page=1, region=region) for pid in sorted(provider_ids)}
+        groups.append(GroupPlan(region, kind, first_pages))
+
+    probe_requests = 0
+    for kind in sorted({g.kind for g in groups}):
+        candidates = [g for g in groups if g.kind == kind and len(g.multi_page_ids) > 1]
+        # pages saved if the OR queries overlapped completely, against the lookups needed
+        # at least for the largest provider: skip the OR probes when they cannot pay off
+        best_case = sum(sum(_pages(g.first_pages[pid]) - 1 for pid in g.multi_page_ids)
+                        - max(_pages(g.first_pages[pid]) for pid in g.multi_page_ids) for g in candidates)
+        lookups = max((_results(g.first_pages[pid]) for g in candidates for pid in g.multi_page_ids), default=0)
+        if not candidates or best_case <= lookups:
+            continue
+        probes = {g: tmdb.discover_page(g.multi_page_ids, kind=kind, page=1, region=g.region) for g in candidates}
+        for g, probe in probes.items():
+            g.combined_first_page = probe
+        chosen = _choose_combined(candidates)
+        for g in candidates:
+            if g not in chosen:
+                g.combined_first_page = None
+                probe_requests += 1
+    return SyncPlan(targets, groups, probe_requests)
+
+
+def _crawl(provider_ids, kind, region, first_page):
+    """Items of every page of a discover query, starting from its probed page 1."""
+    items = list(first_page.get('results', []))
+    for page in range(2, _pages(first_page) + 1):
+        time.sleep(getattr(settings, 'TMDB_REQUEST_DELAY', 0.25))
+        items.extend(tmdb.discover_page(provider_ids, kind=kind, page=page, region=region).get('results', []))
+    return items
+
+
+def _watch_providers(kind, tmdb_id):
+    """{region: {provider_id, ...}} offering a title."""
+    media = 'movie' if kind == 'movies' else 'tv'
+    data = tmdb.tmdb_request(f'{media}/{tmdb_id}/watch/providers')
+    return {region: {p.get('provider_id') for bucket in PROVIDER_BUCKETS for p in offers.get(bucket, [])}
+            for region, offers in (data.get('results') or {}).items()}
+
+
+def execute_plan(plan):
+    """
+    Crawl a SyncPlan. Every title is kept once per provider and kind, with the set of
+    regions where the provider offers it (see PlanResult).
+    """
+    titles = defaultdict(dict)
+    requests = plan.probe_requests
+
+    def attribute(pid, kind, region, item):
+        titles[(pid, kind)].setdefault(item['id'], (item, set()))[1].add(region)
+
+    combined = defaultdict(dict)  # kind -> {tmdb_id: item} to look up
+    appeared = defaultdict(set)   # (kind, tmdb_id) -> (region, combined provider ids) whose OR crawl returned it
+    for group in plan.groups:
+        combined_ids = group.multi_page_ids if group.strategy == 'combined' else []
+        for pid, first_page in group.first_pages.items():
+            requests += 1
+            if pid in combined_ids:
+                continue
+            items = _crawl(pid, group.kind, group.region, first_page)
+            requests += max(_pages(first_page), 1) - 1
+            for it in items:
+                if it.get('id'):
+                    attribute(pid, group.kind, group.region, it)
+        if combined_ids:
+            items = _crawl(combined_ids, group.kind, group.region, group.combined_first_page)
+            requests += group.combined_pages
+            for it in items:
+                if it.get('id'):
+                    combined[group.kind].setdefault(it['id'], it)
+                    appeared[(group.kind, it['id'])].add((group.region, tuple(combined_ids)))
+
+    # one lookup per unique title answers every region at once
+    for kind, items in combined.items():
+        for tmdb_id, it in items.items():
+            providers = _watch_providers(kind, tmdb_id)
+            requests += 1
+            for region, provider_ids in appeared[(kind, tmdb_id)]:
+                for pid in providers.get(region, set()).intersection(provider_ids):
+                    attribute(pid, kind, region, it)
+            time.sleep(getattr(settings, 'TMDB_REQUEST_DELAY', 0.25))
+    return PlanResult(dict(titles), requests)
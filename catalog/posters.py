@@ -0,0 +1,73 @@
+"""
+Poster URLs and the optional local thumbnail cache.
+
+Titles store the TMDB `poster_path`; URLs for each size are built here. When
+settings.POSTER_CACHE_DIR is set, URLs point at the `catalog:poster` proxy, which
+downloads each size once from settings.TMDB_IMAGE_BASE and serves it from disk.
+"""
+import os
+import re
+from pathlib import Path
+
+import requests
+from django.conf import settings
+from django.urls import reverse
+
+from .models import Title
+
+POSTER_SIZES = ('w92', 'w154', 'w300', 'w500')
+# cache file names: a poster_path without its leading slash, e.g. "AisyKEN1zLKRcAPpeJ5G5DaBhyw.jpg"
+POSTER_PATH_RE = re.compile(r'^[A-Za-z0-9_-]+\.(jpg|jpeg|png|webp)$')
+
+
+def cache_dir():
+    path = getattr(settings, 'POSTER_CACHE_DIR', None)
+    return Path(path) if path else None
+
+
+def poster_url(poster_path, size='w300'):
+    """URL of `poster_path` at `size` (through the local cache when it is enabled)."""
+    name = poster_path.lstrip('/')
+    if cache_dir() is not None:
+        return reverse('catalog:poster', args=[size, name])
+    base = getattr(settings, 'TMDB_IMAGE_BASE', 'https://image.tmdb.org/t/p')
+    return f"{base}/{size}/{name}"
+
+
+def poster_srcset(poster_path):
+    return ', '.join(f"{poster_url(poster_path, size)} {size[1:]}w" for size in POSTER_SIZES)
+
+
+def cached_file(size, name):
+    return cache_dir() / size / name
+
+
+def is_catalog_poster(name):
+    """Whether `name` is the poster of some title (any generation)."""
+    return Title.objects.filter(poster_path=f'/{name}').exists()
+
+
+def fetch_to_cache(size, name, session=None, catalog_only=False):
+    """
+    Download one poster size into the cache unless it is already there.
+    Returns (file path, downloaded). Raises ValueError for unknown sizes or malformed
+    names, and with `catalog_only` for posters no title uses (the public proxy must not
+    fill the cache with arbitrary TMDB images).
+    """
+    if size not in POSTER_SIZES or not POSTER_PATH_RE.match(name):
+        raise ValueError(f'Invalid poster {size}/{name}')
+    fname = cached_file(size, name)
+    if fname.exists():
+        return fname, False
+    if catalog_only and not is_catalog_poster(name):
+        raise ValueError(f'Unknown poster {name}')
+
+    base = getattr(settings, 'TMDB_IMAGE_BASE', 'https://image.tmdb.org/t/p')
+    resp = (session or requests).get(f"{base}/{size}/{name}", timeout=20)
+    resp.raise_for_status()
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    tmp = fname.with_name(f".{fname.name}.{os.getpid()}.tmp")
+    with open(tmp, 'wb') as fh:
+        fh.write(resp.content)
+    os.replace(tmp, fname)
+    return fname, True
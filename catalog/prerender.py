@@ -0,0 +1,149 @@
+"""
+Pre-rendering of the hot library pages.
+
+After each TMDB sync or admin change, the unfiltered `biblioteca` page, each
+single-platform view and the first PRERENDER_PAGES pages of `biblioteca_data` are
+written under PRERENDER_ROOT with .gz (and .br when Brotli is installed) variants.
+`catalog.middleware.PrerenderedWhiteNoiseMiddleware` serves them as static files;
+anything else falls through to the dynamic views.
+"""
+import asyncio
+import contextvars
+import gzip
+import os
+import re
+import threading
+import uuid
+from pathlib import Path
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import connection
+from django.test import RequestFactory
+from django.urls import Resolver404, resolve, reverse
+
+from .models import Platform
+
+try:
+    import brotli
+except ImportError:  # optional
+    brotli = None
+
+# url name -> file extension
+PRERENDERED_VIEWS = {'biblioteca': 'html', 'biblioteca_data': 'json'}
+# params a pre-rendered page may carry, with the values that keep the default output
+DEFAULT_PARAMS = {'q': ('',), 'sort': ('', 'pop_desc'), 'page_size': ('', '25')}
+SLUG_RE = re.compile(r'^[-a-zA-Z0-9_]+$')
+
+_lock = threading.Lock()
+
+
+def prerender_root():
+    return Path(getattr(settings, 'PRERENDER_ROOT', Path(settings.BASE_DIR) / 'prerendered'))
+
+
+def _key(url_name, platforms, page):
+    return f"{url_name}/{'+'.join(platforms) or 'all'}/{page}.{PRERENDERED_VIEWS[url_name]}"
+
+
+def path_for_request(request):
+    """
+    File that would hold the pre-rendered response for `request`, or None when the
+    request is not one of the pre-rendered variants (filters, search, other sizes...).
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    try:
+        url_name = resolve(request.path_info).url_name
+    except Resolver404:
+        return None
+    if url_name not in PRERENDERED_VIEWS:
+        return None
+
+    query = request.GET
+    for param in query:
+        if param in DEFAULT_PARAMS:
+            if any(v not in DEFAULT_PARAMS[param] for v in query.getlist(param)):
+                return None
+        elif param not in ('page', 'platforms'):
+            return None
+    platforms = sorted(set(query.getlist('platforms')))
+    if not all(SLUG_RE.match(p) for p in platforms):
+        return None
+    pages = query.getlist('page') or ['1']
+    if len(pages) > 1 or not pages[0].isdigit() or int(pages[0]) < 1:
+        return None
+    return prerender_root() / _key(url_name, platforms, int(pages[0]))
+
+
+def _write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    variants = [(path, content), (Path(f"{path}.gz"), gzip.compress(content, 9))]
+    if brotli is not None:
+        variants.append((Path(f"{path}.br"), brotli.compress(content)))
+    for fname, data in variants:
+        # unique per writer: several workers may pre-render at the same time
+        tmp = fname.with_name(f".{fname.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+        with open(tmp, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmp, fname)
+    return [fname for fname, _ in variants]
+
+
+def _render(view, path, params, **kwargs):
+    request = RequestFactory().get(path, params)
+    if asyncio.iscoroutinefunction(view):
+        return async_to_sync(view)(request, **kwargs).content
+    return view(request, **kwargs).content
+
+
+def prerender_all():
+    """Render every hot page to PRERENDER_ROOT. Returns the number of files written."""
+    from . import views
+
+    with _lock:
+        root = prerender_root()
+        slugs = sorted(Platform.objects.values_list('slug', flat=True))
+        if not slugs:
+            return 0
+        max_pages = getattr(settings, 'PRERENDER_PAGES', 3)
+        # no 'platforms' param (= all), the explicit full selection the page sends, single platforms
+        selections = [[], slugs] + [[s] for s in slugs if len(slugs) > 1]
+
+        written = set()
+        for platforms in selections:
+            for page in range(1, max_pages + 1):
+                params = {'platforms': platforms, 'page': page}
+                data_path = reverse('catalog:biblioteca_data', args=[(platforms or slugs)[0]])
+                content = _render(views.biblioteca_data, data_path, params, slug=(platforms or slugs)[0])
+                written.update(_write(root / _key('biblioteca_data', platforms, page), content))
+                if len(platforms) != len(slugs):
+                    content = _render(views.biblioteca, reverse('catalog:biblioteca'), params)
+                    written.update(_write(root / _key('biblioteca', platforms, page), content))
+
+        # drop files of platforms/pages that no longer exist (dot-files: another worker's temp files)
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                fname = Path(dirpath) / name
+                if not name.startswith('.') and fname not in written:
+                    fname.unlink(missing_ok=True)
+        return len(written)
+
+
+def _prerender_in_thread():
+    try:
+        prerender_all()
+    finally:
+        connection.close()
+
+
+def schedule_prerender():
+    """Refresh the pre-rendered pages after a data change (see PRERENDER_* settings)."""
+    if not getattr(settings, 'PRERENDER_ENABLED', True):
+        return
+    if getattr(settings, 'PRERENDER_IN_BACKGROUND', True):
+        # keep routing context (e.g. use_primary) in the worker thread
+        ctx = contextvars.copy_context()
+        threading.Thread(target=ctx.run, args=(_prerender_in_thread,), daemon=True).start()
+    else:
+        prerender_all()
@@ -0,0 +1,104 @@
+"""
+TMDB reference data (the genre lists) cached in the TMDBReference table and
+refreshed only when older than settings.TMDB_REFERENCE_TTL. SOURCES maps each
+cached key to its fetcher.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import metrics, tmdb
+from .models import Genre, TMDBReference
+
+
+def _fetch_genres():
+    movie = tmdb.tmdb_request('genre/movie/list', params={'language': 'es-ES'})
+    tv = tmdb.tmdb_request('genre/tv/list', params={'language': 'es-ES'})
+    return {'movie': movie.get('genres', []), 'tv': tv.get('genres', [])}
+
+
+SOURCES = {
+    'genres': _fetch_genres,
+}
+
+
+def _is_stale(ref):
+    ttl = getattr(settings, 'TMDB_REFERENCE_TTL', 7 * 24 * 3600)
+    return ref.fetched_at + timedelta(seconds=ttl) <= timezone.now()
+
+
+def get_reference(key, force=False):
+    """
+    Return (TMDBReference, changed). Fetches from TMDB only when the stored copy is
+    missing, stale or `force` is set; `changed` is True when that fetch produced new data.
+    If TMDB fails and a stale copy exists, the stale copy is returned.
+    """
+    ref = TMDBReference.objects.filter(key=key).first()
+    if ref is not None and not force and not _is_stale(ref):
+        metrics.inc('cache_requests_total', cache='tmdb_reference', result='hit')
+        return ref, False
+    metrics.inc('cache_requests_total', cache='tmdb_reference', result='miss')
+
+    try:
+        data = SOURCES[key]()
+    except Exception:
+        if ref is None:
+            raise
+        return ref, False
+
+    now = timezone.now()
+    if ref is None:
+        return TMDBReference.objects.create(key=key, data=data, fetched_at=now), True
+    changed = data != ref.data
+    if changed:
+        ref.data = data
+        ref.version += 1
+    ref.fetched_at = now
+    ref.save()
+    return ref, changed
+
+
+def _sync_genre_rows(data):
+    """Bulk-sync Genre rows ('tmdb-<id>') with the cached genre lists. Returns created count."""
+    wanted = {}
+    for g in data.get('movie', []) + data.get('tv', []):
+        wanted[f"tmdb-{g.get('id')}"] = g.get('name')
+
+    existing = {g.slug: g for g in Genre.objects.filter(slug__in=wanted)}
+    to_create = [Genre(slug=slug, name=name) for slug, name in wanted.items() if slug not in existing]
+    to_update = []
+    for slug, g in existing.items():
+        if g.name != wanted[slug]:
+            g.name = wanted[slug]
+            to_update.append(g)
+    Genre.objects.bulk_create(to_create)
+    Genre.objects.bulk_update(to_update, ['name'])
+    return len(to_create)
+
+
+def ensure_genres(force=False):
+    """Refresh the genre lists if stale and sync Genre rows when they changed. Returns created count."""
+    ref, changed = get_reference('genres', force=force)
+    if not changed:
+        return 0
+    return _sync_genre_rows(ref.data)
+
+
+def genre_pk_map():
+    """{tmdb_genre_id: Genre.pk} for every synced TMDB genre, in one query."""
+    out = {}
+    for slug, pk in Genre.objects.filter(slug__startswith='tmdb-').values_list('slug', 'pk'):
+        gid = slug[len('tmdb-'):]
+        if gid.isdigit():
+            out[int(gid)] = pk
+    return out
+
+
+def genre_pk(genre_map, gid):
+    """Look up a genre pk in `genre_map`, creating (and remembering) a placeholder for unknown ids."""
+    pk = genre_map.get(gid)
+    if pk is None:
+        obj, _ = Genre.objects.get_or_create(slug=f"tmdb-{gid}", defaults={'name': f'Genre {gid}'})
+        pk = genre_map[gid] = obj.pk
+    return pk
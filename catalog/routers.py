@@ -0,0 +1,116 @@
+"""
+Database routing between the primary ('default') and an optional read replica.
+
+Reads go to the 'replica' alias when it is configured, except:
+- inside `use_primary()` blocks (TMDB ingest, admin requests), and
+- for a short window after a sync (`pin_primary()`), so readers see their own writes
+  while the replica catches up.
+
+Writes always go to the primary. The pin lives in the settings.DATABASE_REPLICA_PIN_CACHE
+cache, so with several worker processes that alias must be a shared backend (it is
+when REDIS_URL is set). Each process reads it at most once per PIN_CHECK_INTERVAL
+seconds; the process that pinned sees its own pin immediately.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+PRIMARY = 'default'
+REPLICA = 'replica'
+PIN_CACHE_KEY = 'catalog:db:pin-primary'
+PIN_CHECK_INTERVAL = 1.0
+
+_force_primary = ContextVar('catalog_force_primary', default=False)
+
+
+class _PinState:
+    """Process-local view of the pin (monotonic deadlines)."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.local_until = 0.0
+        self.checked_at = float('-inf')
+        self.shared = False
+
+
+_pin = _PinState()
+
+
+def _pin_cache():
+    return caches[getattr(settings, 'DATABASE_REPLICA_PIN_CACHE', 'default')]
+
+
+def replica_configured():
+    if REPLICA not in settings.DATABASES:
+        return False
+    # a replica pointing at the primary's own database (e.g. the test mirror) adds nothing
+    return connections[REPLICA].settings_dict['NAME'] != connections[PRIMARY].settings_dict['NAME']
+
+
+@contextmanager
+def use_primary():
+    """Route every read in this block (and the code it calls) to the primary."""
+    token = _force_primary.set(True)
+    try:
+        yield
+    finally:
+        _force_primary.reset(token)
+
+
+def pin_primary(seconds=None):
+    """Send all reads to the primary for `seconds` (default settings.DATABASE_REPLICA_STICKY_SECONDS)."""
+    if seconds is None:
+        seconds = getattr(settings, 'DATABASE_REPLICA_STICKY_SECONDS', 30)
+    if seconds > 0 and replica_configured():
+        _pin.local_until = time.monotonic() + seconds
+        _pin_cache().set(PIN_CACHE_KEY, True, seconds)
+
+
+def _pinned():
+    now = time.monotonic()
+    if now < _pin.local_until:
+        return True
+    if now - _pin.checked_at >= PIN_CHECK_INTERVAL:
+        _pin.shared = bool(_pin_cache().get(PIN_CACHE_KEY))
+        _pin.checked_at = now
+    return _pin.shared
+
+
+def writes_to_primary(func):
+    """Decorator for ingest functions: read from the primary while running, then pin reads to it."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with use_primary():
+            try:
+                return func(*args, **kwargs)
+            finally:
+                pin_primary()
+    return wrapper
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if not replica_configured() or _force_primary.get():
+            return PRIMARY
+        if _pinned():
+            return PRIMARY
+        return REPLICA
+
+    def db_for_write(self, model, **hints):
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # both aliases hold the same data
+        return obj1._state.db in (PRIMARY, REPLICA) and obj2._state.db in (PRIMARY, REPLICA)
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # a real replica gets its schema through replication; this only matters for
+        # the local setup where the replica is a second SQLite file (migrate --database=replica)
+        return True
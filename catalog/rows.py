@@ -0,0 +1,53 @@
+"""
+Lean rows for the titles grid.
+
+The grid only needs a handful of columns, so list pages are read with one
+`values_list()` query plus one batched genre query instead of full Title instances
+(whose `description` can be long) with per-card genre/platform lookups. The
+description is only loaded by `title_detail`.
+"""
+from .models import Title
+
+ROW_FIELDS = ('id', 'title', 'type', 'popularity', 'poster_path', 'poster_url', 'platform__slug', 'platform__name')
+TYPE_LABELS = dict(Title.TYPE_CHOICES)
+
+
+class TitleRow:
+    __slots__ = ('id', 'title', 'type', 'popularity', 'poster_path', 'poster_url',
+                 'platform_slug', 'platform_name', 'genre_names')
+
+    def __init__(self, values, genre_names):
+        (self.id, self.title, self.type, self.popularity, self.poster_path, self.poster_url,
+         self.platform_slug, self.platform_name) = values
+        self.genre_names = genre_names
+
+    def get_type_display(self):
+        return TYPE_LABELS.get(self.type, self.type)
+
+
+def row_queryset(qs):
+    """Project a Title queryset onto the grid columns."""
+    return qs.values_list(*ROW_FIELDS)
+
+
+def _genres_query(ids):
+    return Title.genres.through.objects.filter(title_id__in=ids).order_by('pk').values_list('title_id', 'genre__name')
+
+
+def _build(values, genre_pairs):
+    names = {}
+    for title_id, name in genre_pairs:
+        names.setdefault(title_id, []).append(name)
+    return [TitleRow(v, names.get(v[0], [])) for v in values]
+
+
+def title_rows(values_qs):
+    """Evaluate a (sliced) `row_queryset` into TitleRows: two queries in total."""
+    values = list(values_qs)
+    return _build(values, _genres_query([v[0] for v in values]) if values else [])
+
+
+async def atitle_rows(values_qs):
+    values = [v async for v in values_qs]
+    genre_pairs = [p async for p in _genres_query([v[0] for v in values])] if values else []
+    return _build(values, genre_pairs)
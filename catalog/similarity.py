@@ -0,0 +1,286 @@
+"""
+Precomputed "similar titles" index.
+
+Every live title with a tmdb_id gets a feature vector (TMDB genre ids, original
+language from the data/ snapshots, log popularity, type); the top-K cosine
+neighbours are computed offline with batched NumPy matrix products and stored in
+SIMILARITY_INDEX_PATH (.npz). Requests only look neighbours up.
+
+After a sync, `update_index()` recomputes only what changed: rows whose vector
+changed or whose neighbours changed/disappeared are recomputed in full, every other
+row just merges the changed titles into its existing top-K.
+"""
+import contextvars
+import json
+import math
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+
+from . import metrics, tmdb
+from .models import Title
+
+GENRE_WEIGHT = 1.0
+LANGUAGE_WEIGHT = 0.6
+POPULARITY_WEIGHT = 0.4
+TYPE_WEIGHT = 0.5
+# popularity enters as log1p(popularity) in half steps, relative to this ceiling, so small
+# popularity moves between syncs do not change the vector
+POPULARITY_LOG_CEILING = 10.0
+# above this share of changed rows a full rebuild is cheaper than merging
+FULL_REBUILD_RATIO = 0.3
+BATCH_ROWS = 1024
+
+_update_lock = threading.Lock()
+_cache_lock = threading.Lock()
+_cache = {}
+
+
+def index_path():
+    return Path(getattr(settings, 'SIMILARITY_INDEX_PATH', Path(settings.BASE_DIR) / 'data' / 'similarity.npz'))
+
+
+def top_k():
+    return getattr(settings, 'SIMILARITY_TOP_K', 12)
+
+
+def encode_key(tmdb_id, t_type):
+    return tmdb_id * 2 + (1 if t_type == 'series' else 0)
+
+
+def decode_key(key):
+    return key // 2, 'series' if key % 2 else 'movie'
+
+
+def _snapshot_languages():
+    """{key: original_language} from the data/*.json TMDB snapshots."""
+    languages = {}
+    for fname in sorted(tmdb.snapshot_dir().glob('*-*.json')):
+        t_type = 'series' if fname.stem.endswith('-series') else 'movie'
+        try:
+            with open(fname, encoding='utf-8') as fh:
+                items = json.load(fh)
+        except (OSError, ValueError):
+            continue
+        if not isinstance(items, list):
+            continue
+        for it in items:
+            if it.get('id') and it.get('original_language'):
+                languages[encode_key(it['id'], t_type)] = it['original_language']
+    return languages
+
+
+def load_features():
+    """{key: (genre_ids, language, popularity)} for every live title with a tmdb_id (two queries)."""
+    features = {}
+    for tmdb_id, t_type, popularity in Title.objects.live().exclude(tmdb_id=None).values_list('tmdb_id', 'type', 'popularity'):
+        key = encode_key(tmdb_id, t_type)
+        # the same title on several platforms: keep the highest popularity
+        if key not in features or features[key][2] < popularity:
+            features[key] = (set(), '', popularity)
+
+    through = Title.genres.through.objects.filter(title__is_live=True).exclude(title__tmdb_id=None)
+    for tmdb_id, t_type, slug in through.values_list('title__tmdb_id', 'title__type', 'genre__slug'):
+        gid = slug[len('tmdb-'):]
+        if slug.startswith('tmdb-') and gid.isdigit():
+            features[encode_key(tmdb_id, t_type)][0].add(int(gid))
+
+    languages = _snapshot_languages()
+    return {key: (genres, languages.get(key, ''), pop) for key, (genres, _, pop) in features.items()}
+
+
+def _vocabulary(features):
+    genres = sorted({g for genres, _, _ in features.values() for g in genres})
+    langs = sorted({lang for _, lang, _ in features.values() if lang})
+    return np.array(genres, dtype=np.int64), np.array(langs)
+
+
+def _vectors(keys, features, genre_vocab, lang_vocab):
+    genre_col = {g: i for i, g in enumerate(genre_vocab.tolist())}
+    lang_col = {lang: len(genre_col) + i for i, lang in enumerate(lang_vocab.tolist())}
+    pop_col = len(genre_col) + len(lang_col)
+    type_col = pop_col + 1
+
+    vectors = np.zeros((len(keys), type_col + 2), dtype=np.float32)
+    for row, key in enumerate(keys.tolist()):
+        genres, lang, pop = features[key]
+        if genres:
+            cols = [genre_col[g] for g in genres]
+            vectors[row, cols] = GENRE_WEIGHT / math.sqrt(len(cols))
+        if lang:
+            vectors[row, lang_col[lang]] = LANGUAGE_WEIGHT
+        pop_bucket = min(round(math.log1p(max(pop, 0)) * 2) / 2, POPULARITY_LOG_CEILING)
+        vectors[row, pop_col] = POPULARITY_WEIGHT * pop_bucket / POPULARITY_LOG_CEILING
+        vectors[row, type_col + key % 2] = TYPE_WEIGHT
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _top_k_rows(vectors, rows, k):
+    """Top-k neighbours (indices, scores) of `rows` against every vector, in batches."""
+    k = min(k, len(vectors) - 1)
+    neighbours = np.zeros((len(rows), max(k, 0)), dtype=np.int32)
+    scores = np.zeros((len(rows), max(k, 0)), dtype=np.float16)
+    if k <= 0:
+        return neighbours, scores
+    for start in range(0, len(rows), BATCH_ROWS):
+        batch = rows[start:start + BATCH_ROWS]
+        sims = vectors[batch] @ vectors.T
+        sims[np.arange(len(batch)), batch] = -np.inf  # never your own neighbour
+        part = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        part_scores = np.take_along_axis(sims, part, axis=1)
+        order = np.argsort(-part_scores, axis=1)
+        neighbours[start:start + len(batch)] = np.take_along_axis(part, order, axis=1)
+        scores[start:start + len(batch)] = np.take_along_axis(part_scores, order, axis=1)
+    return neighbours, scores
+
+
+def _save(keys, vectors, neighbours, scores, genre_vocab, lang_vocab):
+    path = index_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.stem}.{os.getpid()}.tmp.npz")
+    np.savez_compressed(tmp, keys=keys, vectors=vectors.astype(np.float16), neighbours=neighbours,
+                        scores=scores, genre_vocab=genre_vocab, lang_vocab=lang_vocab)
+    os.replace(tmp, path)
+
+
+def _load():
+    try:
+        with np.load(index_path()) as data:
+            return {name: data[name] for name in data.files}
+    except (OSError, ValueError):
+        return None
+
+
+def build_index(features=None):
+    """Full rebuild. Returns the number of indexed titles."""
+    features = load_features() if features is None else features
+    keys = np.array(sorted(features), dtype=np.int64)
+    genre_vocab, lang_vocab = _vocabulary(features)
+    vectors = _vectors(keys, features, genre_vocab, lang_vocab)
+    neighbours, scores = _top_k_rows(vectors, np.arange(len(keys)), top_k())
+    _save(keys, vectors, neighbours, scores, genre_vocab, lang_vocab)
+    return len(keys)
+
+
+@metrics.timed('similarity_index_seconds')
+def update_index():
+    """
+    Incremental rebuild after a sync. Falls back to a full rebuild when there is no
+    index yet, the genre/language vocabulary changed or too many titles changed.
+    Returns (indexed titles, recomputed rows).
+    """
+    with _update_lock:
+        return _update_index()
+
+
+def _update_index():
+    features = load_features()
+    old = _load()
+    genre_vocab, lang_vocab = _vocabulary(features)
+    k = top_k()
+    if (old is None or not features or old['neighbours'].shape[1] != min(k, max(len(old['keys']) - 1, 0))
+            or not np.array_equal(old['genre_vocab'], genre_vocab) or not np.array_equal(old['lang_vocab'], lang_vocab)):
+        count = build_index(features)
+        return count, count
+
+    keys = np.array(sorted(features), dtype=np.int64)
+    vectors = _vectors(keys, features, genre_vocab, lang_vocab)
+    half = vectors.astype(np.float16)
+
+    # map old rows onto new rows
+    pos = np.searchsorted(keys, old['keys'])
+    pos[pos >= len(keys)] = 0
+    kept = keys[pos] == old['keys']
+    old_to_new = np.where(kept, pos, -1)
+    new_to_old = np.full(len(keys), -1)
+    new_to_old[old_to_new[kept]] = np.nonzero(kept)[0]
+
+    changed = np.ones(len(keys), dtype=bool)
+    survivors = new_to_old >= 0
+    changed[survivors] = np.any(old['vectors'][new_to_old[survivors]] != half[survivors], axis=1)
+    changed_rows = np.nonzero(changed)[0]
+    if len(changed_rows) > FULL_REBUILD_RATIO * len(keys) or len(keys) - 1 < k:
+        count = build_index(features)
+        return count, count
+
+    # old neighbour lists expressed in new row numbers (-1: removed title)
+    old_neighbours = np.full((len(keys), old['neighbours'].shape[1]), -1)
+    old_neighbours[survivors] = old_to_new[old['neighbours'][new_to_old[survivors]]]
+    stale = changed.copy()
+    stale[survivors] |= np.any(old_neighbours[survivors] < 0, axis=1)
+    stale[survivors] |= np.any(changed[np.maximum(old_neighbours[survivors], 0)], axis=1)
+
+    neighbours = np.zeros((len(keys), k), dtype=np.int32)
+    scores = np.zeros((len(keys), k), dtype=np.float16)
+    stale_rows = np.nonzero(stale)[0]
+    neighbours[stale_rows], scores[stale_rows] = _top_k_rows(vectors, stale_rows, k)
+
+    # everything else keeps its list and only considers the changed titles
+    merge_rows = np.nonzero(~stale)[0]
+    for start in range(0, len(merge_rows) if k > 0 else 0, BATCH_ROWS):
+        batch = merge_rows[start:start + BATCH_ROWS]
+        cand = np.concatenate([old_neighbours[batch], np.broadcast_to(changed_rows, (len(batch), len(changed_rows)))], axis=1)
+        cand_scores = np.concatenate([old['scores'][new_to_old[batch]].astype(np.float32),
+                                      vectors[batch] @ vectors[changed_rows].T], axis=1)
+        part = np.argpartition(-cand_scores, k - 1, axis=1)[:, :k]
+        part_scores = np.take_along_axis(cand_scores, part, axis=1)
+        order = np.argsort(-part_scores, axis=1)
+        neighbours[batch] = np.take_along_axis(np.take_along_axis(cand, part, axis=1), order, axis=1)
+        scores[batch] = np.take_along_axis(part_scores, order, axis=1)
+
+    _save(keys, vectors, neighbours, scores, genre_vocab, lang_vocab)
+    return len(keys), len(stale_rows)
+
+
+def _update_in_thread():
+    try:
+        update_index()
+    finally:
+        connection.close()
+
+
+def schedule_index_update():
+    """Refresh the index after a sync (see SIMILARITY_* settings)."""
+    if not getattr(settings, 'SIMILARITY_ENABLED', True):
+        return
+    if getattr(settings, 'SIMILARITY_IN_BACKGROUND', True):
+        ctx = contextvars.copy_context()
+        threading.Thread(target=ctx.run, args=(_update_in_thread,), daemon=True).start()
+    else:
+        update_index()
+
+
+def _index():
+    """Index arrays for serving, reloaded only when the file changes."""
+    path = index_path()
+    try:
+        mtime = path.stat().st_mtime_ns
+    except OSError:
+        return None
+    with _cache_lock:
+        if _cache.get('mtime') != mtime:
+            data = _load()
+            _cache.clear()
+            if data is None:
+                return None
+            _cache.update(mtime=mtime, keys=data['keys'], neighbours=data['neighbours'])
+        return _cache
+
+
+def similar_keys(tmdb_id, t_type):
+    """Neighbour keys of a title, most similar first (empty when it is not indexed)."""
+    index = _index()
+    if index is None or tmdb_id is None:
+        return []
+    key = encode_key(tmdb_id, t_type)
+    keys = index['keys']
+    row = int(np.searchsorted(keys, key))
+    if row >= len(keys) or keys[row] != key:
+        return []
+    return keys[index['neighbours'][row]].tolist()
@@ -0,0 +1,253 @@
+"""
+Single-flight request coalescing for the catalog read views.
+
+Concurrent identical requests (same view, URL kwargs and normalized query string)
+wait for the one already being computed and get a copy of its response instead of
+running the same COUNT, facet loop and templates again. Within a process the waiting
+is on an asyncio future (async views) or a threading.Event (sync views). With
+settings.SINGLEFLIGHT_CACHE naming a cache shared by the workers, a lock in that
+cache extends it across processes: the leader publishes the response under a
+per-flight key and the other processes poll for it.
+
+Nothing outlives the flight: a request arriving after the leader finished computes
+its own response.
+"""
+import asyncio
+import hashlib
+import json
+import threading
+import time
+import uuid
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+
+from . import metrics
+
+_MISSING = object()
+_lock = threading.Lock()
+# (event loop, key) -> asyncio.Future of a frozen response
+_async_flights = {}
+# key -> _Flight
+_sync_flights = {}
+
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _enabled():
+    return getattr(settings, 'SINGLEFLIGHT_ENABLED', True)
+
+
+def _timeout():
+    return getattr(settings, 'SINGLEFLIGHT_TIMEOUT', 10)
+
+
+def _shared_cache():
+    alias = getattr(settings, 'SINGLEFLIGHT_CACHE', None)
+    return caches[alias] if alias else None
+
+
+def request_key(request, view_name, kwargs):
+    """Key of a request: repeated params are order-insensitive (?platforms=a&platforms=b == b&a)."""
+    query = sorted((param, sorted(values)) for param, values in request.GET.lists())
+    raw = json.dumps([view_name, request.method, sorted(kwargs.items()), query], default=str)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def _freeze(response):
+    """Picklable copy of a response, or None when it cannot be shared (streaming)."""
+    if response.streaming:
+        return None
+    return response.status_code, response.content, list(response.items())
+
+
+def _thaw(frozen):
+    status, content, headers = frozen
+    response = HttpResponse(content, status=status)
+    for header, value in headers:
+        response[header] = value
+    return response
+
+
+def _lock_key(key):
+    return f'catalog:singleflight:{key}'
+
+
+def _release(shared, lock_key, token, frozen):
+    # publish (None = the leader failed, stop waiting) before letting the lock go
+    shared.set(f'{lock_key}:{token}', frozen, _timeout())
+    if shared.get(lock_key) == token:
+        shared.delete(lock_key)
+
+
+def _poll(shared, lock_key, token):
+    """Next step for a process waiting on the flight `token` of another one: (done, frozen)."""
+    result_key = f'{lock_key}:{token}'
+    frozen = shared.get(result_key, _MISSING)
+    if frozen is not _MISSING:
+        return True, frozen
+    if shared.get(lock_key) != token:
+        # released (re-read: the result is published first) or expired with its leader
+        frozen = shared.get(result_key, _MISSING)
+        return True, None if frozen is _MISSING else frozen
+    return False, None
+
+
+def _lead(key, view, request, args, kwargs):
+    """Run a sync view, coalescing with other processes through the shared cache."""
+    shared = _shared_cache()
+    if shared is None:
+        return view(request, *args, **kwargs)
+    lock_key, token = _lock_key(key), uuid.uuid4().hex
+    if shared.add(lock_key, token, _timeout()):
+        frozen = None
+        try:
+            response = view(request, *args, **kwargs)
+            frozen = _freeze(response)
+            return response
+        finally:
+            _release(shared, lock_key, token, frozen)
+
+    # the lock may be released while we poll: follow the flight that held it now
+    token = shared.get(lock_key)
+    if token is None:
+        return view(request, *args, **kwargs)
+    deadline = time.monotonic() + _timeout()
+    while time.monotonic() < deadline:
+        done, frozen = _poll(shared, lock_key, token)
+        if done:
+            break
+        time.sleep(getattr(settings, 'SINGLEFLIGHT_POLL_INTERVAL', 0.05))
+    else:
+        frozen = None
+    if frozen is None:
+        return view(request, *args, **kwargs)
+    metrics.inc('singleflight_requests_total', view=view.__name__, role='remote_follower')
+    return _thaw(frozen)
+
+
+async def _alead(key, view, request, args, kwargs):
+    """Async counterpart of `_lead`."""
+    shared = _shared_cache()
+    if shared is None:
+        return await view(request, *args, **kwargs)
+    lock_key, token = _lock_key(key), uuid.uuid4().hex
+    if await shared.aadd(lock_key, token, _timeout()):
+        frozen = None
+        try:
+            response = await view(request, *args, **kwargs)
+            frozen = _freeze(response)
+            return response
+        finally:
+            await sync_to_async(_release)(shared, lock_key, token, frozen)
+
+    token = await shared.aget(lock_key)
+    if token is None:
+        return await view(request, *args, **kwargs)
+    deadline = time.monotonic() + _timeout()
+    while time.monotonic() < deadline:
+        done, frozen = await sync_to_async(_poll)(shared, lock_key, token)
+        if done:
+            break
+        await asyncio.sleep(getattr(settings, 'SINGLEFLIGHT_POLL_INTERVAL', 0.05))
+    else:
+        frozen = None
+    if frozen is None:
+        return await view(request, *args, **kwargs)
+    metrics.inc('singleflight_requests_total', view=view.__name__, role='remote_follower')
+    return _thaw(frozen)
+
+
+def coalesce(view):
+    """Decorator for read-only catalog views whose output does not depend on the user."""
+    name = view.__name__
+
+    if asyncio.iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            if not _enabled() or request.method not in ('GET', 'HEAD'):
+                return await view(request, *args, **kwargs)
+            key = request_key(request, name, kwargs)
+            flight_key = (asyncio.get_running_loop(), key)
+            with _lock:
+                future = _async_flights.get(flight_key)
+                leader = future is None
+                if leader:
+                    future = _async_flights[flight_key] = flight_key[0].create_future()
+
+            if not leader:
+                metrics.inc('singleflight_requests_total', view=name, role='follower')
+                try:
+                    frozen = await asyncio.wait_for(asyncio.shield(future), _timeout())
+                except asyncio.TimeoutError:
+                    frozen = None  # the leader hangs: compute our own
+                except asyncio.CancelledError:
+                    if not future.cancelled():
+                        raise
+                    frozen = None  # the leader was cancelled: compute our own
+                if frozen is None:
+                    return await view(request, *args, **kwargs)
+                return _thaw(frozen)
+
+            metrics.inc('singleflight_requests_total', view=name, role='leader')
+            try:
+                response = await _alead(key, view, request, args, kwargs)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except BaseException as exc:
+                future.set_exception(exc)
+                future.exception()  # retrieved: no "never retrieved" warning without followers
+                raise
+            else:
+                future.set_result(_freeze(response))
+                return response
+            finally:
+                with _lock:
+                    _async_flights.pop(flight_key, None)
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not _enabled() or request.method not in ('GET', 'HEAD'):
+            return view(request, *args, **kwargs)
+        key = request_key(request, name, kwargs)
+        with _lock:
+            flight = _sync_flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _sync_flights[key] = _Flight()
+
+        if not leader:
+            metrics.inc('singleflight_requests_total', view=name, role='follower')
+            if not flight.done.wait(_timeout()):
+                return view(request, *args, **kwargs)
+            if flight.error is not None:
+                raise flight.error
+            if flight.result is None:
+                return view(request, *args, **kwargs)
+            return _thaw(flight.result)
+
+        metrics.inc('singleflight_requests_total', view=name, role='leader')
+        try:
+            response = _lead(key, view, request, args, kwargs)
+            flight.result = _freeze(response)
+            return response
+        except BaseException as exc:
+            flight.error = exc
+            raise
+        finally:
+            with _lock:
+                _sync_flights.pop(key, None)
+            flight.done.set()
+    return wrapper
@@ -0,0 +1,47 @@
+"""
+Template loaders that minify the AJAX partials once, when the template is loaded.
+
+Partials (templates whose file name starts with "_") are returned as JSON strings
+by biblioteca_data/title_detail on every call, so their indentation is paid for on
+every response. The minification is deliberately conservative: lines are stripped,
+blank lines dropped, and lines holding only template tags/comments do not keep
+their newline. Every other line keeps one newline, so whitespace between inline
+elements (and inside <style>/<script>) still renders the same.
+"""
+import os
+import re
+
+from django.conf import settings
+from django.template.loaders import app_directories, filesystem
+
+TAG_ONLY_RE = re.compile(r'^(?:\{%.*?%\}|\{#.*?#\})+$')
+
+
+def is_partial(template_name):
+    return os.path.basename(template_name).startswith('_')
+
+
+def minify(source):
+    out = []
+    for line in source.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        out.append(line if TAG_ONLY_RE.match(line) else line + '\n')
+    return ''.join(out)
+
+
+class MinifyingMixin:
+    def get_contents(self, origin):
+        contents = super().get_contents(origin)
+        if getattr(settings, 'TEMPLATE_MINIFY_PARTIALS', True) and is_partial(origin.template_name):
+            return minify(contents)
+        return contents
+
+
+class FilesystemLoader(MinifyingMixin, filesystem.Loader):
+    pass
+
+
+class AppDirectoriesLoader(MinifyingMixin, app_directories.Loader):
+    pass
@@ -0,0 +1,28 @@
+from django import template
+
+from catalog import posters
+
+register = template.Library()
+
+
+@register.inclusion_tag('catalog/_poster.html')
+def poster(title, width, height, sizes=None, eager=False):
+    """
+    Responsive <img> for a title's poster. `width`/`height` are the rendered box in CSS
+    pixels (reserved to avoid layout shifts); `sizes` defaults to that width.
+    """
+    context = {
+        'alt': title.title,
+        'width': width,
+        'height': height,
+        'sizes': sizes or f'{width}px',
+        'eager': eager,
+        'src': '',
+        'srcset': '',
+    }
+    if title.poster_path:
+        context['src'] = posters.poster_url(title.poster_path, 'w154' if width <= 154 else 'w300')
+        context['srcset'] = posters.poster_srcset(title.poster_path)
+    elif title.poster_url:
+        context['src'] = title.poster_url
+    return context
@@ -1,6 +1,29 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import http.server
+import io
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from unittest import mock
+import numpy as np
+import requests
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpResponse
+from django.test import AsyncClient, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from .models import Platform, Title, Genre
+from . import compression, metrics, pipeline, planner, routers, similarity, singleflight, template_loaders, tmdb
+from .models import CatalogChange, Platform, SyncCheckpoint, Title, Genre, TMDBReference
+from .admin import TitleAdmin
+from .routers import PrimaryReplicaRouter, pin_primary, use_primary
 
 
 class CatalogViewsTest(TestCase):
@@ -19,3 +42,790 @@ class CatalogViewsTest(TestCase):
         resp = self.client.get(reverse('catalog:platform_library', args=[p.slug]))
         self.assertEqual(resp.status_code, 200)
         self.assertContains(resp, 'Test Movie AR')
+
+    def test_biblioteca_data(self):
+        p = Platform.objects.first()
+        resp = self.client.get(reverse('catalog:biblioteca_data', args=[p.slug]), {'platforms': p.slug})
+        self.assertEqual(resp.status_code, 200)
+        data = resp.json()
+        self.assertIn('Test Movie AR', data['titles_html'])
+        self.assertIn('TestGen (1)', data['genres_html'])
+
+    @override_settings(TMDB_WATCH_REGION='UY', SINGLEFLIGHT_ENABLED=False)
+    def test_library_follows_watch_region(self):
+        p = Platform.objects.first()
+        Title.objects.create(platform=p, title='Test Movie UY', type='movie', regions='UY').genres.add(Genre.objects.get())
+        data = self.client.get(reverse('catalog:biblioteca_data', args=[p.slug]), {'platforms': p.slug}).json()
+        self.assertIn('Test Movie UY', data['titles_html'])
+        self.assertNotIn('Test Movie AR', data['titles_html'])
+        self.assertIn('TestGen (1)', data['genres_html'])
+
+    def test_grid_query_count_does_not_grow_with_page(self):
+        p = Platform.objects.first()
+        url = reverse('catalog:biblioteca_data', args=[p.slug])
+        with CaptureQueriesContext(connection) as one_title:
+            self.client.get(url, {'page_size': 100})
+        g = Genre.objects.get()
+        for i in range(30):
+            Title.objects.create(platform=p, title=f'Movie {i}', type='movie', description='x' * 1000).genres.add(g)
+        with CaptureQueriesContext(connection) as many_titles:
+            resp = self.client.get(url, {'page_size': 100})
+        self.assertIn('Movie 29', resp.json()['titles_html'])
+        self.assertEqual(len(one_title), len(many_titles))
+        self.assertFalse(any('description' in q['sql'] for q in many_titles))
+
+    def test_title_detail(self):
+        t = Title.objects.first()
+        resp = self.client.get(reverse('catalog:title_detail', args=[t.id]))
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Test Movie AR', resp.json()['detail_html'])
+        resp = self.client.get(reverse('catalog:title_detail', args=[t.id + 1000]))
+        self.assertEqual(resp.status_code, 404)
+
+
+class DatabaseRouterTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        routers._pin.reset()
+        self.addCleanup(routers._pin.reset)
+        self.router = PrimaryReplicaRouter()
+
+    def test_single_database(self):
+        self.assertEqual(self.router.db_for_read(Title), 'default')
+
+    @mock.patch('catalog.routers.replica_configured', return_value=True)
+    def test_reads_go_to_replica_writes_to_primary(self, _):
+        self.assertEqual(self.router.db_for_read(Title), 'replica')
+        self.assertEqual(self.router.db_for_write(Title), 'default')
+        with use_primary():
+            self.assertEqual(self.router.db_for_read(Title), 'default')
+        self.assertEqual(self.router.db_for_read(Title), 'replica')
+
+    @mock.patch('catalog.routers.replica_configured', return_value=True)
+    def test_reads_stick_to_primary_after_sync(self, _):
+        pin_primary(60)
+        self.assertEqual(self.router.db_for_read(Title), 'default')
+
+    @mock.patch('catalog.routers.replica_configured', return_value=True)
+    def test_pin_of_another_worker_is_read_from_the_pin_cache(self, _):
+        with mock.patch.object(cache, 'get', wraps=cache.get) as cache_get:
+            self.assertEqual(self.router.db_for_read(Title), 'replica')
+            cache.set(routers.PIN_CACHE_KEY, True)  # pinned by another worker
+            self.assertEqual(self.router.db_for_read(Title), 'replica')  # not re-read yet
+            self.assertEqual(cache_get.call_count, 1)
+            with mock.patch('catalog.routers.PIN_CHECK_INTERVAL', 0):
+                self.assertEqual(self.router.db_for_read(Title), 'default')
+
+
+def _discover_page(results, total_pages=1):
+    return {'page': 1, 'total_pages': total_pages, 'results': results}
+
+
+@override_settings(TMDB_GC_IN_BACKGROUND=False, TMDB_REQUEST_DELAY=0, PRERENDER_ENABLED=False, SIMILARITY_ENABLED=False)
+class GeneratePlatformTest(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.snapshot_dir = tmp.name
+        settings_cm = override_settings(TMDB_SNAPSHOT_DIR=tmp.name)
+        settings_cm.enable()
+        self.addCleanup(settings_cm.disable)
+        self.platform = Platform.objects.create(name='Netflix', tmdb_provider_id=8)
+        Title.objects.create(platform=self.platform, title='Old Movie', type='movie', tmdb_id=1, regions='AR')
+
+    def _fake_tmdb(self, path, params=None):
+        if path.startswith('genre/'):
+            return {'genres': [{'id': 28, 'name': 'Acción'}]}
+        return _discover_page([
+            {'id': 2, 'title': 'New Movie', 'popularity': 50.5, 'genre_ids': [28], 'poster_path': '/p.jpg'},
+            {'id': 2, 'title': 'New Movie', 'popularity': 50.5, 'genre_ids': [28]},
+        ])
+
+    def test_generate_swaps_generation(self):
+        with mock.patch('catalog.tmdb.tmdb_request', side_effect=self._fake_tmdb):
+            _, count = tmdb.generate_platform(self.platform, kind='movies')
+        self.assertEqual(count, 1)
+        self.assertEqual(list(Title.objects.values_list('title', 'is_live', 'generation')), [('New Movie', True, 1)])
+        self.assertEqual(list(Title.objects.get().genres.values_list('name', flat=True)), ['Acción'])
+
+    def test_movie_and_series_may_share_a_tmdb_id(self):
+        def fake_tmdb(path, params=None):
+            if path == 'discover/tv':
+                return _discover_page([{'id': 2, 'name': 'New Series'}])
+            return self._fake_tmdb(path, params)
+
+        with mock.patch('catalog.tmdb.tmdb_request', side_effect=fake_tmdb):
+            tmdb.generate_platform(self.platform, kind='movies')
+            tmdb.generate_platform(self.platform, kind='series')
+        self.assertEqual(sorted(Title.objects.live().values_list('type', 'tmdb_id', 'generation')),
+                         [('movie', 2, 1), ('series', 2, 1)])
+
+    def test_genre_lists_are_fetched_once_per_ttl(self):
+        with mock.patch('catalog.tmdb.tmdb_request', side_effect=self._fake_tmdb) as request:
+            tmdb.generate_platform(self.platform, kind='movies')
+            tmdb.generate_platform(self.platform, kind='movies')
+        genre_calls = [c for c in request.call_args_list if c.args[0].startswith('genre/')]
+        self.assertEqual(len(genre_calls), 2)  # movie + tv lists, first run only
+        self.assertEqual(TMDBReference.objects.get(key='genres').version, 1)
+
+    def test_syncs_append_diffs_to_change_feed(self):
+        with mock.patch('catalog.tmdb.tmdb_request', side_effect=self._fake_tmdb):
+            tmdb.generate_platform(self.platform, kind='movies')
+            self.assertEqual(sorted(CatalogChange.objects.values_list('change', 'tmdb_id')), [('added', 2), ('removed', 1)])
+            last = CatalogChange.objects.last().id
+
+            Title.objects.filter(tmdb_id=2).update(popularity=1, title='Renamed')
+            tmdb.generate_platform(self.platform, kind='movies')
+
+        resp = self.client.get(reverse('catalog:changes'), {'since': last})
+        feed = resp.json()
+        self.assertEqual([(c['change'], c['title'], c['popularity'], c['previous_popularity']) for c in feed['changes']],
+                         [('popularity', 'New Movie', 50, 1), ('metadata', 'New Movie', 50, 1)])
+        self.assertEqual(feed['last'], CatalogChange.objects.last().id)
+        self.assertFalse(feed['more'])
+        self.assertEqual(self.client.get(reverse('catalog:changes'), {'since': feed['last']}).json()['changes'], [])
+        self.assertEqual(self.client.get(reverse('catalog:changes'), {'since': 'x'}).status_code, 400)
+
+    def test_update_streams_pages_in_batches(self):
+        def fake_discover(provider_ids, kind='movies', page=1, region=None):
+            return _discover_page([{'id': page * 10 + i, 'title': f'Movie {page}.{i}'} for i in range(3)], total_pages=4)
+
+        with mock.patch('catalog.tmdb.discover_page', side_effect=fake_discover), \
+                mock.patch('catalog.tmdb._reference_genre_map', return_value={}), \
+                override_settings(TMDB_INGEST_BATCH_SIZE=2, TMDB_PIPELINE_QUEUE_PAGES=1):
+            path, count = tmdb.update_platform(self.platform, kind='movies')
+            _, again = tmdb.update_platform(self.platform, kind='movies')
+        self.assertEqual((count, again), (12, 0))
+        self.assertEqual(Title.objects.live().count(), 13)
+        with open(path, encoding='utf-8') as fh:
+            self.assertEqual([it['id'] for it in json.load(fh)], [p * 10 + i for p in range(1, 5) for i in range(3)])
+
+    def test_fetch_thread_stays_a_bounded_number_of_pages_ahead(self):
+        fetched = []
+
+        def fake_discover(provider_ids, kind='movies', page=1, region=None):
+            fetched.append(page)
+            return _discover_page([{'id': page}], total_pages=50)
+
+        with mock.patch('catalog.tmdb.discover_page', side_effect=fake_discover), \
+                override_settings(TMDB_PIPELINE_QUEUE_PAGES=2):
+            pages = pipeline.fetch_pages(8, 'movies')
+            next(pages)
+            time.sleep(0.2)
+            self.assertLessEqual(len(fetched), 4)  # 1 consumed + 2 queued + 1 waiting for room
+            self.assertEqual([page for page, _, _ in pages], list(range(2, 51)))
+
+    def test_failed_sync_keeps_previous_snapshot(self):
+        def failing_discover(provider_ids, kind='movies', page=1, region=None):
+            if page == 3:
+                raise requests.HTTPError('boom')
+            return _discover_page([{'id': page, 'title': f'Movie {page}'}], total_pages=5)
+
+        snapshot = os.path.join(self.snapshot_dir, 'netflix-movies.json')
+        with open(snapshot, 'w', encoding='utf-8') as fh:
+            fh.write('[]')
+        with mock.patch('catalog.tmdb.discover_page', side_effect=failing_discover), \
+                mock.patch('catalog.tmdb._reference_genre_map', return_value={}):
+            with self.assertRaises(requests.HTTPError):
+                tmdb.generate_platform(self.platform, kind='movies')
+        self.assertEqual(list(Title.objects.live().values_list('title', flat=True)), ['Old Movie'])
+        with open(snapshot, encoding='utf-8') as fh:
+            self.assertEqual(json.load(fh), [])
+        # the partial snapshot stays for a resumed run
+        self.assertEqual(sorted(os.listdir(self.snapshot_dir)), ['.netflix-movies.json.partial', 'netflix-movies.json'])
+
+    def _interrupted_generate(self, total_pages=5):
+        def failing_discover(provider_ids, kind='movies', page=1, region=None):
+            if page == 3:
+                raise requests.HTTPError('boom')
+            return _discover_page([{'id': page, 'title': f'Movie {page}'}], total_pages=total_pages)
+
+        with mock.patch('catalog.tmdb.discover_page', side_effect=failing_discover), \
+                mock.patch('catalog.tmdb._reference_genre_map', return_value={}):
+            with self.assertRaises(requests.HTTPError):
+                tmdb.generate_platform(self.platform, kind='movies')
+
+    def test_resumed_generate_continues_after_last_completed_page(self):
+        self._interrupted_generate()
+        checkpoint = SyncCheckpoint.objects.get(platform=self.platform, kind='movies')
+        self.assertEqual((checkpoint.completed_pages, checkpoint.total_pages, checkpoint.created_count), (2, 5, 2))
+        self.assertFalse(checkpoint.finished)
+
+        fetched = []
+
+        def discover(provider_ids, kind='movies', page=1, region=None):
+            fetched.append(page)
+            return _discover_page([{'id': page, 'title': f'Movie {page}'}], total_pages=5)
+
+        with mock.patch('catalog.tmdb.discover_page', side_effect=discover), \
+                mock.patch('catalog.tmdb._reference_genre_map', return_value={}):
+            path, count = tmdb.generate_platform(self.platform, kind='movies', resume=True)
+        # page 1 is probed for total_pages, then the sync picks up at page 3
+        self.assertEqual(fetched, [1, 3, 4, 5])
+        self.assertEqual(count, 5)
+        self.assertEqual(sorted(Title.objects.live().values_list('tmdb_id', flat=True)), [1, 2, 3, 4, 5])
+        with open(path, encoding='utf-8') as fh:
+            self.assertEqual([it['id'] for it in json.load(fh)], [1, 2, 3, 4, 5])
+        self.assertEqual(os.listdir(self.snapshot_dir), ['netflix-movies.json'])
+        self.assertTrue(SyncCheckpoint.objects.get(pk=checkpoint.pk).finished)
+
+    def test_admin_sync_resumes_by_default(self):
+        self._interrupted_generate()
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'x'))
+        fetched = []
+
+        def discover(provider_ids, kind='movies', page=1, region=None):
+            fetched.append(page)
+            return _discover_page([{'id': page, 'title': f'Movie {page}'}], total_pages=5)
+
+        url = reverse('admin:catalog_platform_generate', args=[self.platform.pk])
+        with mock.patch('catalog.tmdb.discover_page', side_effect=discover), \
+                mock.patch('catalog.tmdb._reference_genre_map', return_value={}):
+            self.client.get(url, {'kind': 'movies'})
+            self.assertEqual(fetched, [1, 3, 4, 5])
+            fetched.clear()
+            self.client.get(url, {'kind': 'movies', 'resume': '0'})
+            self.assertEqual(fetched, [1, 2, 3, 4, 5])
+
+    def test_checkpoint_is_discarded_when_total_pages_changes(self):
+        self._interrupted_generate(total_pages=5)
+        fetched = []
+
+        def discover(provider_ids, kind='movies', page=1, region=None):
+            fetched.append(page)
+            return _discover_page([{'id': page, 'title': f'Movie {page}'}], total_pages=8)
+
+        with mock.patch('catalog.tmdb.discover_page', side_effect=discover), \
+                mock.patch('catalog.tmdb._reference_genre_map', return_value={}):
+            path, count = tmdb.generate_platform(self.platform, kind='movies', resume=True)
+        self.assertEqual(fetched, [1, 1, 2, 3, 4, 5, 6, 7, 8])
+        self.assertEqual(count, 8)
+        self.assertEqual(Title.objects.live().count(), 8)
+
+    def test_collection_keeps_generations_still_staging(self):
+        Title.objects.filter(title='Old Movie').update(is_live=False)
+        for generation, is_live in ((1, False), (2, True), (3, False), (4, False)):
+            Title.objects.create(platform=self.platform, title=f'Gen {generation}', type='movie',
+                                 generation=generation, is_live=is_live)
+        # an unfinished sync is staging generation 1; generations 3+ are newer than the live one
+        SyncCheckpoint.objects.create(platform=self.platform, kind='movies', op=SyncCheckpoint.GENERATE, generation=1)
+        self.assertEqual(tmdb.collect_stale_titles(self.platform.pk, 'movies', 2), 1)
+        self.assertEqual(sorted(Title.objects.values_list('generation', flat=True)), [1, 2, 3, 4])
+
+    def test_staged_generation_is_not_visible(self):
+        tmdb._stage_items(self.platform, [tmdb.normalize_item({'id': 2, 'title': 'Staged'}, 'movies')], 'movies', 1, set(), {})
+        self.assertEqual(list(Title.objects.live().values_list('title', flat=True)), ['Old Movie'])
+        tmdb._activate_generation(self.platform, 'movies', 1)
+        self.assertEqual(list(Title.objects.live().values_list('title', flat=True)), ['Staged'])
+
+
+class SyncPlannerTest(TestCase):
+    REGION_IDS = {'AR': 1, 'UY': 2}
+
+    def _fake_discover(self, provider_ids, kind='movies', page=1, region=None):
+        return {'page': page, 'total_pages': 3, 'total_results': 60, 'results': [{'id': page * 100 + self.REGION_IDS[region]}]}
+
+    def test_duplicate_targets_share_one_crawl(self):
+        targets = [(8, 'AR', 'movies'), (8, 'AR', 'movies'), (8, 'UY', 'movies')]
+        with mock.patch('catalog.tmdb.discover_page', side_effect=self._fake_discover) as discover:
+            plan = planner.build_plan(targets)
+        self.assertEqual(plan.naive_requests, 9)
+        self.assertEqual(plan.planned_requests, 6)
+        self.assertEqual(plan.saved_requests, 3)
+        self.assertEqual(discover.call_count, 2)  # probes only
+        self.assertEqual([g.strategy for g in plan.groups], ['split', 'split'])
+
+    def test_combined_crawl_when_cheaper(self):
+        def discover(provider_ids, kind='movies', page=1, region=None):
+            if isinstance(provider_ids, list):
+                return {'total_pages': 1, 'total_results': 2, 'results': [{'id': 1}, {'id': 2}]}
+            return {'total_pages': 20, 'total_results': 2, 'results': []}
+
+        with mock.patch('catalog.tmdb.discover_page', side_effect=discover):
+            plan = planner.build_plan([(8, 'AR', 'movies'), (9, 'AR', 'movies')])
+        self.assertEqual(plan.groups[0].strategy, 'combined')
+        # 2 probes + 1 combined page + 2 watch/providers lookups
+        self.assertEqual(plan.planned_requests, 5)
+        self.assertEqual(plan.naive_requests, 40)
+
+
+    def test_combined_gate_shares_lookups_across_regions(self):
+        # two providers with the same 200 titles (10 pages) in every region
+        def discover(provider_ids, kind='movies', page=1, region=None):
+            return {'total_pages': 10, 'total_results': 200, 'results': []}
+
+        with mock.patch('catalog.tmdb.discover_page', side_effect=discover) as probes:
+            plan = planner.build_plan([(8, 'AR', 'movies'), (9, 'AR', 'movies')])
+        # 8 pages saved cannot pay for 200 lookups: the OR query is not even probed
+        self.assertEqual(probes.call_count, 2)
+        self.assertEqual(plan.groups[0].strategy, 'split')
+
+        regions = [f'R{i}' for i in range(30)]
+        with mock.patch('catalog.tmdb.discover_page', side_effect=discover):
+            plan = planner.build_plan([(pid, r, 'movies') for pid in (8, 9) for r in regions])
+        self.assertEqual({g.strategy for g in plan.groups}, {'combined'})
+        # 30 x (2 probes + 10 combined pages) + 200 lookups shared by every region
+        self.assertEqual(plan.planned_requests, 560)
+        self.assertEqual(plan.naive_requests, 600)
+
+
+@override_settings(TMDB_GC_IN_BACKGROUND=False, TMDB_REQUEST_DELAY=0, PRERENDER_ENABLED=False, SIMILARITY_ENABLED=False)
+class PlannedSyncTest(TestCase):
+    PROVIDERS = {1: {'AR': [8], 'UY': [8, 9]}, 2: {'AR': [9]}}
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        settings_cm = override_settings(TMDB_SNAPSHOT_DIR=tmp.name)
+        settings_cm.enable()
+        self.addCleanup(settings_cm.disable)
+        self.netflix = Platform.objects.create(name='Netflix', tmdb_provider_id=8)
+        self.disney = Platform.objects.create(name='Disney', tmdb_provider_id=9)
+        self.small = Platform.objects.create(name='Small', tmdb_provider_id=10)
+        Title.objects.create(platform=self.netflix, title='Old Movie', type='movie', tmdb_id=99)
+
+    def _fake_discover(self, provider_ids, kind='movies', page=1, region=None):
+        if isinstance(provider_ids, list):
+            return {'total_pages': 1, 'total_results': 2, 'results': [{'id': 1, 'title': 'One'}, {'id': 2, 'title': 'Two'}]}
+        if provider_ids == 10:
+            return {'total_pages': 1, 'total_results': 1, 'results': [{'id': 3, 'title': 'Three'}] if region == 'AR' else []}
+        return {'total_pages': 5, 'total_results': 2, 'results': []}
+
+    def _fake_tmdb(self, path, params=None):
+        tmdb_id = int(path.split('/')[1])
+        return {'results': {region: {'flatrate': [{'provider_id': pid} for pid in pids]}
+                            for region, pids in self.PROVIDERS.get(tmdb_id, {}).items()}}
+
+    def _titles(self, platform):
+        return sorted(Title.objects.live().filter(platform=platform).values_list('tmdb_id', 'regions'))
+
+    def test_plan_feeds_the_sync(self):
+        with mock.patch('catalog.tmdb.discover_page', side_effect=self._fake_discover), \
+                mock.patch('catalog.tmdb.tmdb_request', side_effect=self._fake_tmdb) as lookups, \
+                mock.patch('catalog.tmdb._reference_genre_map', return_value={}):
+            plan, created, requests = tmdb.generate_planned([self.netflix, self.disney, self.small],
+                                                             kinds=('movies',), regions=['AR', 'UY'])
+        self.assertEqual([g.strategy for g in plan.groups], ['combined', 'combined'])
+        # both regions returned titles 1 and 2, looked up once each
+        self.assertEqual(lookups.call_count, 2)
+        # 6 probes, 2 combined pages, 2 lookups
+        self.assertEqual(requests, 10)
+        self.assertEqual(created, {('netflix', 'movies'): 1, ('disney', 'movies'): 2, ('small', 'movies'): 1})
+        self.assertEqual(self._titles(self.netflix), [(1, 'AR,UY')])
+        self.assertEqual(self._titles(self.disney), [(1, 'UY'), (2, 'AR')])
+        self.assertEqual(self._titles(self.small), [(3, 'AR')])
+        self.assertTrue(SyncCheckpoint.objects.get(platform=self.netflix, kind='movies').finished)
+        # the replaced generation is collected
+        self.assertFalse(Title.objects.filter(tmdb_id=99).exists())
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        metrics.reset()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.metrics_dir = tmp.name
+        settings_cm = override_settings(METRICS_DIR=tmp.name)
+        settings_cm.enable()
+        self.addCleanup(settings_cm.disable)
+        Platform.objects.create(name='TestPlat')
+
+    def test_metrics_requires_staff_or_token(self):
+        self.assertEqual(self.client.get(reverse('catalog:metrics')).status_code, 403)
+        with override_settings(METRICS_TOKEN='s3cret'):
+            resp = self.client.get(reverse('catalog:metrics'), HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_view_latency_is_exported(self):
+        self.client.get(reverse('catalog:biblioteca_data', args=['testplat']))
+        with override_settings(METRICS_TOKEN='s3cret'):
+            body = self.client.get(reverse('catalog:metrics'), HTTP_AUTHORIZATION='Bearer s3cret').content.decode()
+        self.assertIn('catalog_view_seconds_count{view="biblioteca_data"} 1', body)
+        self.assertIn('# TYPE catalog_facet_seconds histogram', body)
+
+    def test_samples_from_several_processes_are_summed(self):
+        with tempfile.TemporaryDirectory() as tmp, override_settings(METRICS_DIR=tmp):
+            with open(os.path.join(tmp, '1.json'), 'w') as fh:
+                json.dump({'counters': [['tmdb_pages_total', [['kind', 'movies']], 3]], 'histograms': []}, fh)
+            metrics.inc('tmdb_pages_total', 2, kind='movies')
+            counters, _ = metrics.collect()
+        self.assertEqual(counters[('tmdb_pages_total', (('kind', 'movies'),))], 5)
+
+    def test_files_of_dead_processes_are_folded_into_one(self):
+        child = subprocess.Popen(['true'])
+        child.wait()
+        dead = os.path.join(self.metrics_dir, f'{child.pid}-abcd.json')
+        with open(dead, 'w') as fh:
+            json.dump({'counters': [['tmdb_pages_total', [['kind', 'movies']], 3]], 'histograms': []}, fh)
+        metrics.inc('tmdb_pages_total', 2, kind='movies')
+        for _ in range(2):
+            counters, _ = metrics.collect()
+            self.assertEqual(counters[('tmdb_pages_total', (('kind', 'movies'),))], 5)
+        self.assertFalse(os.path.exists(dead))
+        self.assertEqual(len([f for f in os.listdir(self.metrics_dir) if f.endswith('.json')]), 2)
+
+    def test_flush_runs_in_background_into_a_per_process_file(self):
+        with tempfile.TemporaryDirectory() as tmp, override_settings(METRICS_DIR=tmp, METRICS_FLUSH_INTERVAL=0):
+            metrics.inc('tmdb_pages_total', kind='movies')
+            for thread in threading.enumerate():
+                if thread.name == 'metrics-flush':
+                    thread.join(5)
+            files = os.listdir(tmp)
+        self.assertEqual(len(files), 1)
+        self.assertRegex(files[0], rf'^{os.getpid()}-[0-9a-f]+\.json$')
+
+
+class _FakeImageHandler(http.server.BaseHTTPRequestHandler):
+    requests_seen = []
+
+    def do_GET(self):
+        self.requests_seen.append(self.path)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.end_headers()
+        self.wfile.write(b'JPEG' + self.path.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class PosterTest(TestCase):
+    def setUp(self):
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), _FakeImageHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        _FakeImageHandler.requests_seen = []
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.image_base = f'http://127.0.0.1:{self.server.server_port}/t/p'
+        p = Platform.objects.create(name='TestPlat')
+        self.title = Title.objects.create(platform=p, title='Poster Movie', type='movie', poster_path='/abc.jpg')
+
+    def test_grid_uses_lazy_srcset(self):
+        html = self.client.get(reverse('catalog:biblioteca_data', args=['testplat'])).json()['titles_html']
+        self.assertIn('loading="lazy"', html)
+        self.assertIn('width="72" height="108"', html)
+        self.assertIn('https://image.tmdb.org/t/p/w92/abc.jpg 92w', html)
+        self.assertIn('https://image.tmdb.org/t/p/w500/abc.jpg 500w', html)
+
+    def test_poster_proxy_caches_each_size_once(self):
+        with override_settings(POSTER_CACHE_DIR=self.tmp.name, TMDB_IMAGE_BASE=self.image_base):
+            html = self.client.get(reverse('catalog:biblioteca_data', args=['testplat'])).json()['titles_html']
+            self.assertIn('/poster/w92/abc.jpg 92w', html)
+            for _ in range(2):
+                resp = self.client.get(reverse('catalog:poster', args=['w92', 'abc.jpg']))
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(b''.join(resp.streaming_content), b'JPEG/t/p/w92/abc.jpg')
+                resp.close()
+            self.assertEqual(self.client.get(reverse('catalog:poster', args=['w1', 'abc.jpg'])).status_code, 404)
+            # not the poster of any title: never fetched
+            self.assertEqual(self.client.get(reverse('catalog:poster', args=['w92', 'other.jpg'])).status_code, 404)
+        self.assertEqual(_FakeImageHandler.requests_seen, ['/t/p/w92/abc.jpg'])
+
+    def test_warm_posters_from_snapshots(self):
+        with override_settings(POSTER_CACHE_DIR=self.tmp.name, TMDB_IMAGE_BASE=self.image_base):
+            call_command('warm_posters', '--size', 'w92', '--limit', '2', stdout=io.StringIO())
+        self.assertTrue(_FakeImageHandler.requests_seen)
+        self.assertTrue(all(path.startswith('/t/p/w92/') for path in _FakeImageHandler.requests_seen))
+
+
+class PrerenderTest(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        p = Platform.objects.create(name='TestPlat')
+        Title.objects.create(platform=p, title='Prerendered Movie', type='movie', regions='AR')
+
+    def test_hot_pages_are_served_without_queries(self):
+        with override_settings(PRERENDER_ROOT=self.tmp.name, PRERENDER_PAGES=1):
+            call_command('prerender', stdout=io.StringIO())
+            with self.assertNumQueries(0):
+                resp = self.client.get(reverse('catalog:biblioteca'))
+                self.assertContains(resp, 'Prerendered Movie')
+                resp = self.client.get(reverse('catalog:biblioteca_data', args=['testplat']),
+                                       {'platforms': 'testplat', 'q': '', 'sort': 'pop_desc', 'page_size': 25},
+                                       HTTP_ACCEPT_ENCODING='gzip')
+                self.assertEqual(resp['Content-Encoding'], 'gzip')
+                self.assertIn('Prerendered Movie', json.loads(gzip.decompress(b''.join(resp.streaming_content)))['titles_html'])
+            # filtered requests still hit the views
+            resp = self.client.get(reverse('catalog:biblioteca_data', args=['testplat']), {'q': 'nada'})
+            self.assertNotIn('Prerendered Movie', resp.json()['titles_html'])
+
+    def test_pages_are_streamed_without_a_sync_worker_under_asgi(self):
+        with override_settings(PRERENDER_ROOT=self.tmp.name, PRERENDER_PAGES=1):
+            call_command('prerender', stdout=io.StringIO())
+
+            async def fetch():
+                resp = await AsyncClient().get(reverse('catalog:biblioteca'))
+                return resp, b''.join([chunk async for chunk in resp])
+            with self.assertNumQueries(0):
+                resp, body = async_to_sync(fetch)()
+        self.assertTrue(resp.is_async)
+        self.assertIn(b'Prerendered Movie', body)
+
+
+    def test_refresh_leaves_temp_files_of_other_workers(self):
+        root = os.path.join(self.tmp.name, 'biblioteca_data', 'all')
+        os.makedirs(root)
+        other_tmp = os.path.join(root, '.1.json.999.abc.tmp')
+        stale = os.path.join(root, '9.json')
+        for fname in (other_tmp, stale):
+            open(fname, 'w').close()
+        with override_settings(PRERENDER_ROOT=self.tmp.name, PRERENDER_PAGES=1):
+            call_command('prerender', stdout=io.StringIO())
+        self.assertTrue(os.path.exists(other_tmp))
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(os.path.join(root, '1.json')))
+
+
+class SimilarityTest(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        settings_cm = override_settings(SIMILARITY_INDEX_PATH=os.path.join(self.tmp.name, 'similarity.npz'),
+                                        SIMILARITY_TOP_K=2)
+        settings_cm.enable()
+        self.addCleanup(settings_cm.disable)
+
+        self.netflix = Platform.objects.create(name='Netflix')
+        self.disney = Platform.objects.create(name='Disney')
+        action, drama = Genre.objects.create(name='Acción', slug='tmdb-28'), Genre.objects.create(name='Drama', slug='tmdb-18')
+        self.titles = {}
+        for tmdb_id, platform, genres in [(1, self.netflix, [action]), (2, self.disney, [action]),
+                                          (3, self.netflix, [action]), (4, self.netflix, [drama]),
+                                          (5, self.netflix, [drama]), (6, self.netflix, [drama])]:
+            t = Title.objects.create(platform=platform, title=f'Movie {tmdb_id}', type='movie', tmdb_id=tmdb_id, popularity=10)
+            t.genres.set(genres)
+            self.titles[tmdb_id] = t
+
+    def test_detail_shows_neighbours_on_selected_platforms(self):
+        call_command('build_similarity', '--full', stdout=io.StringIO())
+        self.assertEqual(sorted(similarity.decode_key(k)[0] for k in similarity.similar_keys(1, 'movie')), [2, 3])
+
+        url = reverse('catalog:title_detail', args=[self.titles[1].id])
+        html = self.client.get(url).json()['detail_html']
+        self.assertIn('Movie 2', html)
+        self.assertIn('Movie 3', html)
+        self.assertNotIn('Movie 4', html)
+        html = self.client.get(url, {'platforms': 'netflix'}).json()['detail_html']
+        self.assertNotIn('Movie 2', html)
+        self.assertIn('Movie 3', html)
+
+    def test_incremental_update_recomputes_only_affected_rows(self):
+        self.assertEqual(similarity.update_index(), (6, 6))  # no index yet: full build
+        self.assertEqual(similarity.update_index(), (6, 0))
+
+        # one new drama title: only it and the rows that were pointing at changed titles are recomputed
+        t = Title.objects.create(platform=self.netflix, title='Movie 7', type='movie', tmdb_id=7, popularity=10)
+        t.genres.set(Genre.objects.filter(slug='tmdb-18'))
+        with mock.patch.object(similarity, 'BATCH_ROWS', 2):  # merged in several batches
+            count, recomputed = similarity.update_index()
+        self.assertEqual(count, 7)
+        self.assertEqual(recomputed, 1)
+        self.assertEqual(len(similarity.similar_keys(7, 'movie')), 2)
+        self.assertIn(similarity.decode_key(similarity.similar_keys(7, 'movie')[0])[0], [4, 5, 6])
+        incremental = similarity._load()['scores']
+        similarity.build_index()
+        self.assertTrue(np.array_equal(incremental, similarity._load()['scores']))
+
+
+class SingleFlightTest(TestCase):
+    def setUp(self):
+        self.platform = Platform.objects.create(name='TestPlat')
+        g = Genre.objects.create(name='TestGen', slug='testgen')
+        for i in range(5):
+            Title.objects.create(platform=self.platform, title=f'Movie {i}', type='movie', regions='AR').genres.add(g)
+        self.url = reverse('catalog:biblioteca_data', args=[self.platform.slug])
+
+    def _burst(self, concurrency):
+        """Queries run by `concurrency` identical biblioteca_data requests arriving together."""
+        from . import views
+
+        async def burst():
+            requests = [RequestFactory().get(self.url, {'platforms': self.platform.slug, 'q': 'movie'})
+                        for _ in range(concurrency)]
+            return await asyncio.gather(*(views.biblioteca_data(r, slug=self.platform.slug) for r in requests))
+
+        with CaptureQueriesContext(connection) as queries:
+            responses = async_to_sync(burst)()
+        self.assertEqual(len({r.content for r in responses}), 1)
+        self.assertIn('Movie 4', json.loads(responses[-1].content)['titles_html'])
+        return len(queries)
+
+    def test_query_count_stays_flat_under_concurrency(self):
+        counts = [self._burst(n) for n in (1, 10, 50)]
+        self.assertEqual(counts, [counts[0]] * 3)
+        with override_settings(SINGLEFLIGHT_ENABLED=False):
+            self.assertEqual(self._burst(10), 10 * counts[0])
+
+    def test_request_key_ignores_param_order(self):
+        rf = RequestFactory()
+        key = singleflight.request_key(rf.get('/x', {'platforms': ['a', 'b']}), 'v', {'slug': 'a'})
+        self.assertEqual(key, singleflight.request_key(rf.get('/x', {'platforms': ['b', 'a']}), 'v', {'slug': 'a'}))
+        self.assertNotEqual(key, singleflight.request_key(rf.get('/x', {'platforms': ['a']}), 'v', {'slug': 'a'}))
+
+    @override_settings(SINGLEFLIGHT_CACHE='default', SINGLEFLIGHT_POLL_INTERVAL=0.01)
+    def test_waits_for_flight_of_another_process(self):
+        request = RequestFactory().get(self.url)
+        lock_key = f"catalog:singleflight:{singleflight.request_key(request, 'biblioteca_data', {'slug': self.platform.slug})}"
+        # another worker holds the lock and publishes its response
+        cache.set(lock_key, 'other-worker')
+        cache.set(f'{lock_key}:other-worker', (200, b'{"titles_html": "shared"}', [('Content-Type', 'application/json')]))
+        self.addCleanup(cache.clear)
+        with self.assertNumQueries(0):
+            resp = self.client.get(self.url)
+        self.assertEqual(resp.json()['titles_html'], 'shared')
+
+        # lock released without a result: compute locally
+        cache.delete(lock_key)
+        resp = self.client.get(self.url)
+        self.assertIn('Movie 0', resp.json()['titles_html'])
+
+    @override_settings(SINGLEFLIGHT_TIMEOUT=0.05)
+    def test_async_follower_stops_waiting_for_a_hung_leader(self):
+        calls = []
+
+        @singleflight.coalesce
+        async def view(request):
+            calls.append(request)
+            if len(calls) == 1:
+                await asyncio.sleep(5)  # hung leader
+            return HttpResponse(b'computed')
+
+        async def follow():
+            leader = asyncio.ensure_future(view(RequestFactory().get('/x')))
+            await asyncio.sleep(0)
+            try:
+                return await view(RequestFactory().get('/x'))
+            finally:
+                leader.cancel()
+
+        start = time.monotonic()
+        response = async_to_sync(follow)()
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(response.content, b'computed')
+        self.assertEqual(len(calls), 2)
+
+    @override_settings(SINGLEFLIGHT_CACHE='default', SINGLEFLIGHT_POLL_INTERVAL=0.01)
+    def test_follower_gets_result_after_leader_releases(self):
+        self.addCleanup(cache.clear)
+        calls, running, release = [], threading.Event(), threading.Event()
+
+        def view(request):
+            calls.append(request)
+            running.set()
+            release.wait(5)
+            return HttpResponse(b'computed')
+
+        request = RequestFactory().get('/x')
+        responses = {}
+
+        def run(role):
+            responses[role] = singleflight._lead('k', view, request, (), {})
+
+        leader = threading.Thread(target=run, args=('leader',))
+        leader.start()
+        running.wait(5)
+        follower = threading.Thread(target=run, args=('follower',))
+        follower.start()
+        time.sleep(0.05)  # the follower is polling
+        release.set()
+        leader.join(5)
+        follower.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(responses['follower'].content, b'computed')
+
+
+class CompressionTest(TestCase):
+    def setUp(self):
+        p = Platform.objects.create(name='TestPlat')
+        for i in range(30):
+            Title.objects.create(platform=p, title=f'Movie {i}', type='movie', regions='AR')
+        self.url = reverse('catalog:biblioteca_data', args=[p.slug])
+
+    def test_negotiates_encoding_above_threshold(self):
+        resp = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp['Vary'])
+        self.assertIn('Movie 24', json.loads(gzip.decompress(resp.content))['titles_html'])
+
+        resp = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertFalse(resp.has_header('Content-Encoding'))
+        with override_settings(COMPRESSION_MIN_SIZE=10 ** 6):
+            resp = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(resp.has_header('Content-Encoding'))
+        self.assertIn('Accept-Encoding', resp['Vary'])
+
+    def test_negotiate(self):
+        self.assertEqual(compression.negotiate('deflate, gzip;q=0.5'), 'gzip')
+        self.assertEqual(compression.negotiate('*'), compression.available_encodings()[0])
+        self.assertIsNone(compression.negotiate('identity'))
+        self.assertIsNone(compression.negotiate(''))
+
+    def test_partials_are_minified(self):
+        source = '<div>\n  {% if x %}\n    <span>a</span>\n    <span>b</span>\n  {% endif %}\n\n</div>\n'
+        self.assertEqual(template_loaders.minify(source), '<div>\n{% if x %}<span>a</span>\n<span>b</span>\n{% endif %}</div>\n')
+        resp = self.client.get(self.url)
+        self.assertNotIn('\n  ', resp.json()['titles_html'])
+
+
+class LargeCatalogAdminTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'x'))
+        self.platforms = [Platform.objects.create(name=f'Plat {i}') for i in range(3)]
+        for i in range(9):
+            Title.objects.create(platform=self.platforms[i % 3], title=f'Movie {i}', type='movie')
+        self.url = reverse('admin:catalog_title_changelist')
+
+    def test_changelist_pages_with_cursor(self):
+        with mock.patch.object(TitleAdmin, 'list_per_page', 4):
+            resp = self.client.get(self.url)
+            self.assertContains(resp, 'Movie 8')
+            self.assertNotContains(resp, 'Movie 4<')
+            next_url = resp.context['cl'].next_page_url
+            self.assertIn('cursor=', next_url)
+
+            resp = self.client.get(self.url + next_url)
+            self.assertContains(resp, 'Movie 4<')
+            self.assertNotContains(resp, 'Movie 5<')
+            resp = self.client.get(self.url + resp.context['cl'].next_page_url)
+            self.assertContains(resp, 'Movie 0<')
+            self.assertIsNone(resp.context['cl'].next_cursor)
+
+            # sorting by a column uses numbered pages
+            resp = self.client.get(self.url, {'o': '1'})
+            self.assertFalse(resp.context['cl'].cursor_mode)
+
+    def test_change_feed_rows_go_only_with_their_platform(self):
+        platform = self.platforms[0]
+        change = CatalogChange.objects.create(platform=platform, type='movie', tmdb_id=1, change='added', title='Movie 0')
+        resp = self.client.get(reverse('admin:catalog_catalogchange_delete', args=[change.pk]))
+        self.assertEqual(resp.status_code, 403)
+        with override_settings(PRERENDER_ENABLED=False):
+            resp = self.client.post(reverse('admin:catalog_platform_changelist'),
+                                    {'action': 'delete_selected', '_selected_action': [platform.pk], 'post': 'yes'})
+        self.assertEqual(resp.status_code, 302)
+        self.assertFalse(CatalogChange.objects.exists())
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(self.url)
+        for i in range(20):
+            Title.objects.create(platform=Platform.objects.create(name=f'Other {i}'), title=f'Extra {i}', type='movie')
+        with CaptureQueriesContext(connection) as many:
+            self.client.get(self.url)
+        self.assertEqual(len(few), len(many))
+
+    def test_filtered_counts_are_capped(self):
+        with override_settings(ADMIN_COUNT_LIMIT=3):
+            resp = self.client.get(self.url, {'q': 'Movie'})
+            self.assertEqual(resp.context['cl'].result_count, 4)
+            self.assertContains(resp, '3+ titles')
+            self.assertContains(self.client.get(self.url, {'q': 'Movie', 'o': '1'}), '3+ titles')
+        self.assertContains(self.client.get(self.url, {'q': 'Movie'}), '9 titles')
+
+    def test_platform_action_links(self):
+        resp = self.client.get(reverse('admin:catalog_platform_changelist'))
+        pk = self.platforms[1].pk
+        self.assertContains(resp, f'href="/admin/catalog/platform/{pk}/update/?kind=series">Upd S</a>', html=False)
@@ -1,10 +1,17 @@
+import contextvars
 import os
 import requests
 from django.conf import settings
 from pathlib import Path
-from .models import Title, Genre
+from .models import SyncCheckpoint, Title, Genre
 import time
-from django.db import transaction
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils.text import slugify
+import threading
+from .routers import writes_to_primary
+from . import changes, checkpoints, metrics, pipeline, planner, prerender, reference, similarity
+from functools import wraps
 
 
 def get_tmdb_api_key():
@@ -19,12 +26,41 @@ def tmdb_request(path, params=None):
     base = 'https://api.themoviedb.org/3'
     params = params.copy() if params else {}
     params['api_key'] = get_tmdb_api_key()
-    resp = requests.get(f"{base}/{path}", params=params, timeout=20)
+    with metrics.timer('tmdb_stage_seconds', stage='fetch'):
+        resp = requests.get(f"{base}/{path}", params=params, timeout=20)
+    metrics.inc('tmdb_requests_total', endpoint=path.split('/')[0], status=resp.status_code)
+    if resp.status_code == 429:
+        metrics.inc('tmdb_rate_limited_total')
     resp.raise_for_status()
-    return resp.json()
+    with metrics.timer('tmdb_stage_seconds', stage='parse'):
+        return resp.json()
 
 
-def discover_movies(provider_id, region='AR', max_pages=5):
+def watch_region():
+    """Default TMDB watch region for syncs (settings.TMDB_WATCH_REGION)."""
+    return getattr(settings, 'TMDB_WATCH_REGION', 'AR')
+
+
+def discover_endpoint(kind):
+    return 'discover/movie' if kind == 'movies' else 'discover/tv'
+
+
+def discover_page(provider_ids, kind='movies', page=1, region=None):
+    """
+    Fetch one discover page. `provider_ids` is one id or several, which TMDB
+    combines with OR ('8|337').
+    """
+    if isinstance(provider_ids, (list, tuple, set, frozenset)):
+        provider_ids = '|'.join(str(p) for p in sorted(provider_ids))
+    return tmdb_request(discover_endpoint(kind), params={
+        'with_watch_providers': provider_ids,
+        'watch_region': region or watch_region(),
+        'page': page,
+        'language': 'es-ES',
+    })
+
+
+def discover_movies(provider_id, region=None, max_pages=5):
     # returns list of movie dicts from TMDB discover endpoint filtered by provider
     results = []
     page = 1
@@ -33,7 +69,7 @@ def discover_movies(provider_id, region='AR', max_pages=5):
         # https://api.themoviedb.org/3/discover/movie?api_key=API_KEY&with_watch_providers=PROVIDER_ID&watch_region=AR&language=es-ES&page=PAGE
         data = tmdb_request('discover/movie', params={
             'with_watch_providers': provider_id,
-            'watch_region': region,
+            'watch_region': region or watch_region(),
             'page': page,
             # Use Spanish (Spain) like your scraper example; TMDB supports es-ES
             'language': 'es-ES',
@@ -47,13 +83,13 @@ def discover_movies(provider_id, region='AR', max_pages=5):
     return results
 
 
-def discover_tv(provider_id, region='AR', max_pages=5):
+def discover_tv(provider_id, region=None, max_pages=5):
     results = []
     page = 1
     while page <= max_pages:
         data = tmdb_request('discover/tv', params={
             'with_watch_providers': provider_id,
-            'watch_region': region,
+            'watch_region': region or watch_region(),
             'page': page,
             'language': 'es-ES',
         })
@@ -65,199 +101,293 @@ def discover_tv(provider_id, region='AR', max_pages=5):
     return results
 
 
-def get_total_pages(provider_id, kind='movies', region='AR'):
+def get_total_pages(provider_id, kind='movies', region=None):
     # Query first page to get total_pages
-    endpoint = 'discover/movie' if kind == 'movies' else 'discover/tv'
-    data = tmdb_request(endpoint, params={
-        'with_watch_providers': provider_id,
-        'watch_region': region,
-        'page': 1,
-        'language': 'es-ES',
-    })
+    data = discover_page(provider_id, kind=kind, page=1, region=region)
     return int(data.get('total_pages', 1)), data.get('results', [])
 
 
-def fetch_and_sync_genres():
-    """Fetch genre lists for movies and tv from TMDB and sync to Genre model."""
-    movie = tmdb_request('genre/movie/list', params={'language': 'es-ES'})
-    tv = tmdb_request('genre/tv/list', params={'language': 'es-ES'})
-    all_genres = []
-    for g in movie.get('genres', []):
-        all_genres.append(('movie', g))
-    for g in tv.get('genres', []):
-        all_genres.append(('tv', g))
-
-    created = 0
-    for kind, g in all_genres:
-        gid = g.get('id')
-        name = g.get('name')
-        slug = f"tmdb-{gid}"
-        obj, was_new = Genre.objects.update_or_create(slug=slug, defaults={'name': name})
-        if was_new:
-            created += 1
-    return created
-
-
-def _create_or_update_title_from_item(platform, it, kind='movies'):
-    # Use TMDB id as unique key when available
-    tmdb_id = it.get('id')
-    if kind == 'movies':
-        title_text = it.get('title') or it.get('original_title')
-        t_type = 'movie'
-    else:
-        title_text = it.get('name') or it.get('original_name')
-        t_type = 'series'
-
-    popularity = int(it.get('popularity') or 0)
-    description = it.get('overview') or ''
-    poster_path = it.get('poster_path')
-    poster_url = f"https://image.tmdb.org/t/p/w300{poster_path}" if poster_path else ''
-
-    # use tmdb_id when present
-    if tmdb_id:
-        t_obj, created = Title.objects.get_or_create(
-            platform=platform,
-            tmdb_id=tmdb_id,
-            defaults={
-                'title': title_text,
-                'type': t_type,
-                'popularity': popularity,
-                'description': description,
-                'poster_url': poster_url,
-                'regions': 'AR',
-            }
-        )
-        if not created:
-            t_obj.title = title_text
-            t_obj.type = t_type
-            t_obj.popularity = popularity
-            t_obj.description = description
-            t_obj.poster_url = poster_url
-            t_obj.regions = 'AR'
-            t_obj.save()
-    else:
-        # fallback to title-based upsert
-        t_obj, created = Title.objects.get_or_create(
-            platform=platform,
-            title=title_text,
-            defaults={
-                'type': t_type,
-                'popularity': popularity,
-                'description': description,
-                'poster_url': poster_url,
-                'regions': 'AR',
-            }
-        )
-
-    # genres from genre_ids -> map to synced Genre objects when available
-    genre_ids = it.get('genre_ids', [])
-    if genre_ids:
-        genre_objs = []
-        for gid in genre_ids:
-            slug = f"tmdb-{gid}"
-            # if genre exists it will have proper name from fetch_and_sync_genres
-            obj, _ = Genre.objects.get_or_create(slug=slug, defaults={'name': f'Genre {gid}'})
-            genre_objs.append(obj)
-        t_obj.genres.set(genre_objs)
-
-    return t_obj
-
-
-def generate_platform(platform, kind='movies'):
-    """Generate full dataset for platform: delete existing and fetch all pages."""
-    pid = platform.tmdb_provider_id
-    if not pid:
-        raise ValueError('Platform does not have tmdb_provider_id set')
-
-    # sync genres first
+def _reference_genre_map():
+    """Genre map for one sync run: refresh cached genre lists only when stale."""
     try:
-        fetch_and_sync_genres()
+        reference.ensure_genres()
     except Exception:
         # non-fatal: continue even if genres can't be synced
         pass
+    return reference.genre_pk_map()
+
+
+def _title_type(kind):
+    return 'movie' if kind == 'movies' else 'series'
+
+
+def normalize_item(it, kind):
+    """Title fields of one TMDB discover item."""
+    title_text = (it.get('title') or it.get('original_title')) if kind == 'movies' else (it.get('name') or it.get('original_name'))
+    return {
+        'tmdb_id': it.get('id'),
+        'title': title_text,
+        'popularity': int(it.get('popularity') or 0),
+        'description': it.get('overview') or '',
+        'poster_path': it.get('poster_path') or '',
+        'genre_ids': it.get('genre_ids', []),
+    }
+
+
+def _stage_items(platform, records, kind, generation, seen, genre_map, is_live=False):
+    """
+    Bulk-insert one batch of normalized items (`normalize_item`, plus an optional
+    'regions' string) as Titles of `generation`, non-live unless `is_live`. `seen` collects keys already staged so items repeated
+    across pages are kept once.
+    """
+    t_type = _title_type(kind)
+    titles = []
+    item_genres = []
+    for rec in records:
+        key = rec['tmdb_id'] or rec['title']
+        if key in seen:
+            continue
+        seen.add(key)
+        titles.append(Title(
+            platform=platform,
+            tmdb_id=rec['tmdb_id'],
+            title=rec['title'],
+            slug=slugify(rec['title'] or ''),
+            type=t_type,
+            popularity=rec['popularity'],
+            description=rec['description'],
+            poster_path=rec['poster_path'],
+            regions=rec.get('regions') or watch_region(),
+            generation=generation,
+            is_live=is_live,
+        ))
+        item_genres.append(rec['genre_ids'])
 
-    total_pages, first_page_results = get_total_pages(pid, kind=kind)
-    all_items = []
-    all_items.extend(first_page_results)
-
-    # fetch remaining pages
-    for page in range(2, total_pages + 1):
-        endpoint = 'discover/movie' if kind == 'movies' else 'discover/tv'
-        data = tmdb_request(endpoint, params={
-            'with_watch_providers': pid,
-            'watch_region': 'AR',
-            'page': page,
-            'language': 'es-ES',
-        })
-        all_items.extend(data.get('results', []))
-        time.sleep(getattr(settings, 'TMDB_REQUEST_DELAY', 0.25))
+    with transaction.atomic():
+        Title.objects.bulk_create(titles)
+        Title.genres.through.objects.bulk_create([
+            Title.genres.through(title_id=t.pk, genre_id=reference.genre_pk(genre_map, gid))
+            for t, gids in zip(titles, item_genres)
+            for gid in dict.fromkeys(gids)
+        ])
+    return len(titles)
+
+
+def _activate_generation(platform, kind, generation):
+    """Atomically make `generation` the live data for platform/kind."""
+    t_type = _title_type(kind)
+    with transaction.atomic():
+        Title.objects.filter(platform=platform, type=t_type, is_live=True).update(is_live=False)
+        Title.objects.filter(platform=platform, type=t_type, generation=generation).update(is_live=True)
+
+
+def collect_stale_titles(platform_id, kind, live_generation):
+    """
+    Delete the generations replaced by `live_generation` (older, non-live) in small
+    batches. Newer ones and the generation of an unfinished sync (SyncCheckpoint) may
+    still be staging and are kept.
+    """
+    batch_size = getattr(settings, 'TMDB_INGEST_BATCH_SIZE', 500)
+    staging = SyncCheckpoint.objects.filter(platform_id=platform_id, kind=kind, finished=False).values('generation')
+    stale = (Title.objects.filter(platform_id=platform_id, type=_title_type(kind), is_live=False,
+                                  generation__lt=live_generation)
+             .exclude(generation__in=staging))
+    removed = 0
+    while True:
+        pks = list(stale.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return removed
+        Title.objects.filter(pk__in=pks).delete()
+        removed += len(pks)
+
+
+def _collect_in_background(platform_id, kind, live_generation):
+    try:
+        collect_stale_titles(platform_id, kind, live_generation)
+    finally:
+        connection.close()
 
-    # delete existing titles for this platform & kind
-    Title.objects.filter(platform=platform, type=('movie' if kind == 'movies' else 'series')).delete()
 
-    created_count = 0
-    with transaction.atomic():
-        for it in all_items:
-            _create_or_update_title_from_item(platform, it, kind=kind)
-            created_count += 1
+def schedule_stale_titles_collection(platform, kind, live_generation):
+    if getattr(settings, 'TMDB_GC_IN_BACKGROUND', True):
+        # keep routing context (use_primary) in the worker thread
+        ctx = contextvars.copy_context()
+        threading.Thread(target=ctx.run, args=(_collect_in_background, platform.pk, kind, live_generation),
+                         daemon=True).start()
+    else:
+        collect_stale_titles(platform.pk, kind, live_generation)
+
+
+def _count_page(kind, items):
+    metrics.inc('tmdb_pages_total', kind=kind)
+    metrics.inc('tmdb_items_total', len(items), kind=kind)
+
+
+def instrumented_sync(op):
+    """Record the duration of a sync function and flush metrics when it ends."""
+    def decorator(func):
+        timed_func = metrics.timed('tmdb_sync_seconds', op=op)(func)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return timed_func(*args, **kwargs)
+            finally:
+                metrics.flush(force=True)
+        return wrapper
+    return decorator
+
+
+@writes_to_primary
+@instrumented_sync('generate')
+def generate_platform(platform, kind='movies', resume=False):
+    """
+    Generate full dataset for platform: stream all pages into a new, non-live generation
+    (see catalog.pipeline), then swap it in atomically. Visitors keep seeing the
+    previous data until the swap. With `resume`, an interrupted run continues after
+    its last completed page (catalog.checkpoints).
+    """
+    if not platform.tmdb_provider_id:
+        raise ValueError('Platform does not have tmdb_provider_id set')
 
-    save_path = save_json_for_platform(platform.slug, kind, all_items)
+    genre_map = _reference_genre_map()
+    t_type = _title_type(kind)
+    before = changes.capture(platform, t_type)
+    checkpoint = checkpoints.resumable(platform, kind, SyncCheckpoint.GENERATE) if resume else None
+    if checkpoint is not None:
+        generation = checkpoint.generation
+        staged = Title.objects.filter(platform=platform, type=t_type, generation=generation)
+        seen = {tmdb_id or title for tmdb_id, title in staged.values_list('tmdb_id', 'title')}
+    else:
+        generation = (Title.objects.filter(platform=platform, type=t_type).aggregate(m=Max('generation'))['m'] or 0) + 1
+        checkpoint = checkpoints.start(platform, kind, SyncCheckpoint.GENERATE, generation)
+        seen = set()
+
+    # stage into the new generation, one short transaction per batch
+    save_path, created_count = pipeline.run(
+        platform, kind, lambda records: _stage_items(platform, records, kind, generation, seen, genre_map), checkpoint)
+
+    _activate_generation(platform, kind, generation)
+    changes.record(platform, t_type, before, changes.capture(platform, t_type))
+    schedule_stale_titles_collection(platform, kind, generation)
+    prerender.schedule_prerender()
+    # after the snapshot: the index reads original_language from it
+    similarity.schedule_index_update()
     return save_path, created_count
 
 
-def update_platform(platform, kind='movies'):
-    """Update dataset for platform: fetch all pages and add new items not already present (by tmdb_id)."""
-    pid = platform.tmdb_provider_id
-    if not pid:
-        raise ValueError('Platform does not have tmdb_provider_id set')
+def sync_regions():
+    """Watch regions of the planned multi-region syncs (settings.TMDB_SYNC_REGIONS)."""
+    return list(getattr(settings, 'TMDB_SYNC_REGIONS', None) or [watch_region()])
 
-    try:
-        fetch_and_sync_genres()
-    except Exception:
-        pass
 
-    total_pages, first_page_results = get_total_pages(pid, kind=kind)
-    new_items = []
-
-    # process first page
-    pages = [1]
-    pages.extend(range(2, total_pages + 1))
-    created_count = 0
-    all_items = []
-    for page in pages:
-        endpoint = 'discover/movie' if kind == 'movies' else 'discover/tv'
-        data = tmdb_request(endpoint, params={
-            'with_watch_providers': pid,
-            'watch_region': 'AR',
-            'page': page,
-            'language': 'es-ES',
-        })
-        items = data.get('results', [])
-        all_items.extend(items)
-        for it in items:
-            tmdb_id = it.get('id')
-            exists = False
-            if tmdb_id:
-                exists = Title.objects.filter(platform=platform, tmdb_id=tmdb_id).exists()
-            else:
-                # fallback: check by title
-                title_text = it.get('title') or it.get('name') or it.get('original_title') or it.get('original_name')
-                exists = Title.objects.filter(platform=platform, title=title_text).exists()
-            if not exists:
-                _create_or_update_title_from_item(platform, it, kind=kind)
-                created_count += 1
+def _ingest_planned(platform, kind, entries, genre_map):
+    """
+    Stage the (discover item, regions) `entries` of one platform/kind as a new
+    generation and swap it in, like generate_platform does with its streamed pages.
+    """
+    t_type = _title_type(kind)
+    before = changes.capture(platform, t_type)
+    generation = (Title.objects.filter(platform=platform, type=t_type).aggregate(m=Max('generation'))['m'] or 0) + 1
+    # an unfinished checkpoint keeps the staged generation from being collected meanwhile
+    checkpoint = checkpoints.start(platform, kind, SyncCheckpoint.GENERATE, generation)
+    batch_size = getattr(settings, 'TMDB_INGEST_BATCH_SIZE', 500)
+    seen = set()
+    created = 0
+    partial = checkpoints.partial_snapshot_path(platform, kind)
+    with pipeline.SnapshotWriter(platform.slug, kind, partial) as snapshot:
+        for start in range(0, len(entries), batch_size):
+            batch = entries[start:start + batch_size]
+            snapshot.extend(it for it, _ in batch)
+            records = [dict(normalize_item(it, kind), regions=','.join(sorted(regions))) for it, regions in batch]
+            created += _stage_items(platform, records, kind, generation, seen, genre_map)
+    checkpoints.finish(checkpoint)
+
+    _activate_generation(platform, kind, generation)
+    changes.record(platform, t_type, before, changes.capture(platform, t_type))
+    schedule_stale_titles_collection(platform, kind, generation)
+    return created
 
-        time.sleep(getattr(settings, 'TMDB_REQUEST_DELAY', 0.25))
 
-    save_path = save_json_for_platform(platform.slug, kind, all_items)
+@writes_to_primary
+@instrumented_sync('generate_planned')
+def generate_planned(platforms, kinds=('movies', 'series'), regions=None):
+    """
+    Generate several platforms over several watch regions (default: sync_regions())
+    from one request plan (catalog.planner) instead of one crawl per platform and
+    region. Each platform/kind gets a new generation holding every title once, with
+    the regions that offer it in Title.regions.
+    Returns (the SyncPlan, {(platform slug, kind): titles created}, TMDB requests made).
+    """
+    platforms = [p for p in platforms if p.tmdb_provider_id]
+    if not platforms:
+        raise ValueError('No platform has tmdb_provider_id set')
+    regions = regions or sync_regions()
+
+    plan = planner.build_plan([(p.tmdb_provider_id, r, k) for p in platforms for r in regions for k in kinds])
+    result = planner.execute_plan(plan)
+    genre_map = _reference_genre_map()
+    created = {}
+    for platform in platforms:
+        for kind in kinds:
+            entries = list(result.titles.get((platform.tmdb_provider_id, kind), {}).values())
+            created[(platform.slug, kind)] = _ingest_planned(platform, kind, entries, genre_map)
+    prerender.schedule_prerender()
+    similarity.schedule_index_update()
+    return plan, created, result.requests
+
+
+def _new_records(live, records):
+    """The records of one batch whose title is not live yet (by tmdb_id, else by title)."""
+    ids = [r['tmdb_id'] for r in records if r['tmdb_id']]
+    names = [r['title'] for r in records if not r['tmdb_id']]
+    existing_ids = set(live.filter(tmdb_id__in=ids).values_list('tmdb_id', flat=True)) if ids else set()
+    existing_names = set(live.filter(title__in=names).values_list('title', flat=True)) if names else set()
+    return [r for r in records
+            if not (r['tmdb_id'] in existing_ids if r['tmdb_id'] else r['title'] in existing_names)]
+
+
+@writes_to_primary
+@instrumented_sync('update')
+def update_platform(platform, kind='movies', resume=False):
+    """
+    Update dataset for platform: stream all pages and add items not already present (by tmdb_id).
+    With `resume`, an interrupted run continues after its last completed page.
+    """
+    if not platform.tmdb_provider_id:
+        raise ValueError('Platform does not have tmdb_provider_id set')
+
+    genre_map = _reference_genre_map()
+    t_type = _title_type(kind)
+    # new titles join the generation readers currently see
+    live = Title.objects.live().filter(platform=platform, type=t_type)
+    generation = live.aggregate(m=Max('generation'))['m'] or 0
+    before = changes.capture(platform, t_type)
+    checkpoint = checkpoints.resumable(platform, kind, SyncCheckpoint.UPDATE) if resume else None
+    if checkpoint is None or checkpoint.generation != generation:
+        checkpoint = checkpoints.start(platform, kind, SyncCheckpoint.UPDATE, generation)
+
+    seen = set()
+    save_path, created_count = pipeline.run(
+        platform, kind,
+        lambda records: _stage_items(platform, _new_records(live, records), kind, generation, seen, genre_map, is_live=True),
+        checkpoint)
+
+    changes.record(platform, t_type, before, changes.capture(platform, t_type))
+    prerender.schedule_prerender()
+    similarity.schedule_index_update()
     return save_path, created_count
 
 
+@writes_to_primary
 def delete_platform_data(platform, kind='movies'):
     # delete DB entries and JSON file
-    Title.objects.filter(platform=platform, type=('movie' if kind == 'movies' else 'series')).delete()
-    base = Path(settings.BASE_DIR)
-    fname = base / 'data' / f"{platform.slug}-{kind}.json"
+    t_type = _title_type(kind)
+    before = changes.capture(platform, t_type)
+    Title.objects.filter(platform=platform, type=t_type).delete()
+    changes.record(platform, t_type, before, {})
+    prerender.schedule_prerender()
+    fname = snapshot_dir() / f"{platform.slug}-{kind}.json"
     if fname.exists():
         fname.unlink()
         removed = True
@@ -277,10 +407,15 @@ def ensure_genres(tmdb_genre_list):
     return created
 
 
+def snapshot_dir():
+    """Directory of the <slug>-<kind>.json TMDB snapshots."""
+    return Path(getattr(settings, 'TMDB_SNAPSHOT_DIR', Path(settings.BASE_DIR) / 'data'))
+
+
+@metrics.timed('tmdb_stage_seconds', stage='snapshot')
 def save_json_for_platform(platform_slug, kind, data):
     # kind: 'movies' or 'series'
-    base = Path(settings.BASE_DIR)
-    outdir = base / 'data'
+    outdir = snapshot_dir()
     outdir.mkdir(exist_ok=True)
     fname = outdir / f"{platform_slug}-{kind}.json"
     with open(fname, 'w', encoding='utf-8') as fh:
@@ -289,6 +424,7 @@ def save_json_for_platform(platform_slug, kind, data):
     return str(fname)
 
 
+@writes_to_primary
 def refresh_platform_from_tmdb(platform, kind='movies'):
     """Fetch movies or tv for a Platform (requires platform.tmdb_provider_id) and save JSON and update DB titles."""
     pid = platform.tmdb_provider_id
@@ -329,8 +465,7 @@ def refresh_platform_from_tmdb(platform, kind='movies'):
 
         popularity = int(it.get('popularity') or 0)
         description = it.get('overview') or ''
-        poster_path = it.get('poster_path')
-        poster_url = f"https://image.tmdb.org/t/p/w300{poster_path}" if poster_path else ''
+        poster_path = it.get('poster_path') or ''
 
         # create or update
         t_obj, created = Title.objects.get_or_create(
@@ -340,16 +475,16 @@ def refresh_platform_from_tmdb(platform, kind='movies'):
                 'type': t_type,
                 'popularity': popularity,
                 'description': description,
-                'poster_url': poster_url,
-                'regions': 'AR',
+                'poster_path': poster_path,
+                'regions': watch_region(),
             }
         )
         if not created:
             t_obj.type = t_type
             t_obj.popularity = popularity
             t_obj.description = description
-            t_obj.poster_url = poster_url
-            t_obj.regions = 'AR'
+            t_obj.poster_path = poster_path
+            t_obj.regions = watch_region()
             t_obj.save()
         if genre_objs:
             t_obj.genres.set(genre_objs)
@@ -8,4 +8,7 @@ urlpatterns = [
     path('biblioteca/', views.biblioteca, name='biblioteca'),
     path('platform/<slug:slug>/data', views.biblioteca_data, name='biblioteca_data'),
     path('title/<int:title_id>/detail', views.title_detail, name='title_detail'),
+    path('poster/<str:size>/<str:name>', views.poster, name='poster'),
+    path('changes', views.changes, name='changes'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
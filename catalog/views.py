@@ -1,9 +1,17 @@
-from django.shortcuts import render, get_object_or_404
-from .models import Platform, Title, Genre
+import hmac
+import mimetypes
+import requests
+from django.conf import settings
+from django.shortcuts import render
+from .models import CatalogChange, Platform, Title, Genre
 from django.db.models import Q
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.template.loader import render_to_string
-from django.http import JsonResponse
+from django.http import FileResponse, JsonResponse, Http404, HttpResponse
+from . import metrics, posters, rows, similarity, singleflight, tmdb
+
+SIMILAR_LIMIT = 8
+CHANGES_LIMIT = 500
 
 
 def _apply_genre_filter_and(qs, selected_genres):
@@ -19,6 +27,71 @@ def _apply_genre_filter_and(qs, selected_genres):
     return qs
 
 
+class _CountedPaginator(Paginator):
+    """Paginator whose count was already computed (e.g. with `acount()`)."""
+
+    def __init__(self, object_list, per_page, count, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.count = count
+
+
+def _selected_platforms(request, all_slugs):
+    """Platforms chosen via the repeated 'platforms' GET param; all of them when none is valid."""
+    selected_platforms_param = request.GET.getlist('platforms')
+    if selected_platforms_param:
+        # Filter to valid platforms only
+        selected_platforms = [p for p in selected_platforms_param if p in all_slugs]
+        if selected_platforms:
+            return selected_platforms
+    # No platform param: show all
+    return all_slugs
+
+
+def _filtered_titles(request, selected_platforms):
+    """
+    Build the library queryset from the request filters (search, type, genres, sort).
+    Returns (qs, q, selected_types, selected_genres, sort).
+    """
+    qs = Title.objects.live().filter(platform__slug__in=selected_platforms, regions__icontains=tmdb.watch_region()).distinct()
+
+    # search
+    q = request.GET.get('q', '').strip()
+    if q:
+        qs = qs.filter(Q(title__icontains=q) | Q(description__icontains=q))
+
+    # type filters
+    selected_types = request.GET.getlist('type')
+    if selected_types:
+        qs = qs.filter(type__in=selected_types)
+
+    # genres (AND logic: title must have ALL selected genres)
+    selected_genres = request.GET.getlist('genre')
+    if selected_genres:
+        qs = _apply_genre_filter_and(qs, selected_genres)
+
+    # sorting
+    sort = request.GET.get('sort')
+    if sort == 'pop_asc':
+        qs = qs.order_by('popularity')
+    elif sort == 'pop_desc':
+        qs = qs.order_by('-popularity')
+    else:
+        qs = qs.order_by('-popularity')
+
+    return qs, q, selected_types, selected_genres, sort
+
+
+def _page_size(request):
+    try:
+        page_size = int(request.GET.get('page_size', 25))
+    except ValueError:
+        page_size = 25
+    if page_size not in (25, 50, 100):
+        page_size = 25
+    return page_size
+
+
+@metrics.timed('catalog_view_seconds', view='index')
 def index(request):
     platforms = list(Platform.objects.all())
     # compute a resolved logo URL for each platform (prefer local static files)
@@ -39,6 +112,8 @@ def index(request):
     return render(request, 'catalog/index.html', {'platforms': platforms})
 
 
+@metrics.timed('catalog_view_seconds', view='biblioteca')
+@singleflight.coalesce
 def biblioteca(request):
     """
     Unified library view. Accepts optional 'platforms' query parameter (multiple).
@@ -49,55 +124,16 @@ def biblioteca(request):
     all_slugs = [p.slug for p in supported_platforms]
     
     # Get the selected platforms from query params (can be multiple)
-    selected_platforms_param = request.GET.getlist('platforms')
-    
-    if selected_platforms_param:
-        # Filter to valid platforms only
-        selected_platforms = [p for p in selected_platforms_param if p in all_slugs]
-        if not selected_platforms:
-            selected_platforms = all_slugs
-    else:
-        # No platform param: show all
-        selected_platforms = all_slugs
+    selected_platforms = _selected_platforms(request, all_slugs)
     
     current_platform = supported_platforms.filter(slug__in=selected_platforms).first() or supported_platforms.first()
     
-    # Base queryset
-    qs = Title.objects.filter(platform__slug__in=selected_platforms, regions__icontains='AR').distinct()
-    
-    # search
-    q = request.GET.get('q', '').strip()
-    if q:
-        qs = qs.filter(Q(title__icontains=q) | Q(description__icontains=q))
-    
-    # type filters
-    selected_types = request.GET.getlist('type')
-    if selected_types:
-        qs = qs.filter(type__in=selected_types)
-    
-    # genres (AND logic: title must have ALL selected genres)
-    selected_genres = request.GET.getlist('genre')
-    if selected_genres:
-        qs = _apply_genre_filter_and(qs, selected_genres)
-    
-    # sorting
-    sort = request.GET.get('sort')
-    if sort == 'pop_asc':
-        qs = qs.order_by('popularity')
-    elif sort == 'pop_desc':
-        qs = qs.order_by('-popularity')
-    else:
-        qs = qs.order_by('-popularity')
+    qs, q, selected_types, selected_genres, sort = _filtered_titles(request, selected_platforms)
     
     # pagination
-    try:
-        page_size = int(request.GET.get('page_size', 25))
-    except ValueError:
-        page_size = 25
-    if page_size not in (25, 50, 100):
-        page_size = 25
+    page_size = _page_size(request)
     
-    paginator = Paginator(qs, page_size)
+    paginator = Paginator(rows.row_queryset(qs), page_size)
     page = request.GET.get('page', 1)
     try:
         page_obj = paginator.page(page)
@@ -105,14 +141,16 @@ def biblioteca(request):
         page_obj = paginator.page(1)
     except EmptyPage:
         page_obj = paginator.page(paginator.num_pages)
+    page_obj.object_list = rows.title_rows(page_obj.object_list)
     
     # genres with counts
-    genres = Genre.objects.order_by('name')
-    genres_with_counts = []
-    for g in genres:
-        count = Title.objects.filter(platform__slug__in=selected_platforms, regions__icontains='AR', genres=g).count()
-        if count > 0:
-            genres_with_counts.append({'slug': g.slug, 'name': g.name, 'count': count})
+    with metrics.timer('catalog_facet_seconds', view='biblioteca'):
+        genres = Genre.objects.order_by('name')
+        genres_with_counts = []
+        for g in genres:
+            count = Title.objects.live().filter(platform__slug__in=selected_platforms, regions__icontains=tmdb.watch_region(), genres=g).count()
+            if count > 0:
+                genres_with_counts.append({'slug': g.slug, 'name': g.name, 'count': count})
     
     # Determine header text
     is_all_platforms = len(selected_platforms) == len(all_slugs)
@@ -136,75 +174,58 @@ def biblioteca(request):
     return render(request, 'catalog/biblioteca.html', context)
 
 
-def biblioteca_data(request, slug):
+async def _apaginate(qs, page_size, page):
     """
-    AJAX endpoint for biblioteca. Accepts multiple 'platforms' params via GET.
-    Returns JSON with titles_html and genres_html.
+    Async counterpart of the pagination block in `biblioteca`: COUNT runs through
+    the async ORM and the page is evaluated into TitleRows before the templates touch it.
     """
-    supported_platforms = Platform.objects.all()
-    all_slugs = [p.slug for p in supported_platforms]
-    
-    # Get selected platforms from query param (can be multiple)
-    selected_platforms_param = request.GET.getlist('platforms')
-    
-    if selected_platforms_param:
-        selected_platforms = [p for p in selected_platforms_param if p in all_slugs]
-        if not selected_platforms:
-            selected_platforms = all_slugs
-    else:
-        selected_platforms = all_slugs
-    
-    current_platform = supported_platforms.filter(slug__in=selected_platforms).first() or supported_platforms.first()
-    
-    # Reuse biblioteca logic
-    qs = Title.objects.filter(platform__slug__in=selected_platforms, regions__icontains='AR').distinct()
-    
-    q = request.GET.get('q', '').strip()
-    if q:
-        qs = qs.filter(Q(title__icontains=q) | Q(description__icontains=q))
-    
-    selected_types = request.GET.getlist('type')
-    if selected_types:
-        qs = qs.filter(type__in=selected_types)
-    
-    selected_genres = request.GET.getlist('genre')
-    if selected_genres:
-        qs = _apply_genre_filter_and(qs, selected_genres)
-    
-    sort = request.GET.get('sort')
-    if sort == 'pop_asc':
-        qs = qs.order_by('popularity')
-    elif sort == 'pop_desc':
-        qs = qs.order_by('-popularity')
-    else:
-        qs = qs.order_by('-popularity')
-    
-    try:
-        page_size = int(request.GET.get('page_size', 25))
-    except ValueError:
-        page_size = 25
-    if page_size not in (25, 50, 100):
-        page_size = 25
-    
-    paginator = Paginator(qs, page_size)
-    page = request.GET.get('page', 1)
+    row_qs = rows.row_queryset(qs)
+    paginator = _CountedPaginator(row_qs, page_size, await row_qs.acount())
     try:
         page_obj = paginator.page(page)
     except PageNotAnInteger:
         page_obj = paginator.page(1)
     except EmptyPage:
         page_obj = paginator.page(paginator.num_pages)
-    
-    # genres
-    genres = Genre.objects.order_by('name')
+    page_obj.object_list = await rows.atitle_rows(page_obj.object_list)
+    return paginator, page_obj
+
+
+@metrics.timed('catalog_facet_seconds', view='biblioteca_data')
+async def _agenres_with_counts(selected_platforms):
     genres_with_counts = []
-    for g in genres:
-        count = Title.objects.filter(platform__slug__in=selected_platforms, regions__icontains='AR', genres=g).count()
+    async for g in Genre.objects.order_by('name'):
+        count = await Title.objects.live().filter(platform__slug__in=selected_platforms, regions__icontains=tmdb.watch_region(), genres=g).acount()
         if count > 0:
             genres_with_counts.append({'slug': g.slug, 'name': g.name, 'count': count})
-    
+    return genres_with_counts
+
+
+@metrics.timed('catalog_view_seconds', view='biblioteca_data')
+@singleflight.coalesce
+async def biblioteca_data(request, slug):
+    """
+    AJAX endpoint for biblioteca. Accepts multiple 'platforms' params via GET.
+    Returns JSON with titles_html and genres_html.
+    """
+    supported_platforms = [p async for p in Platform.objects.all()]
+    all_slugs = [p.slug for p in supported_platforms]
+    selected_platforms = _selected_platforms(request, all_slugs)
+
+    current_platform = next((p for p in supported_platforms if p.slug in selected_platforms), None)
+    if current_platform is None and supported_platforms:
+        current_platform = supported_platforms[0]
+
+    # Reuse biblioteca logic
+    qs, q, selected_types, selected_genres, sort = _filtered_titles(request, selected_platforms)
+    page_size = _page_size(request)
+
+    # both go through the request's thread-sensitive DB connection, so they run one after the other
+    paginator, page_obj = await _apaginate(qs, page_size, request.GET.get('page', 1))
+    genres_with_counts = await _agenres_with_counts(selected_platforms)
+
     is_all_platforms = len(selected_platforms) == len(all_slugs)
-    
+
     titles_context = {
         'page_obj': page_obj,
         'paginator': paginator,
@@ -217,24 +238,126 @@ def biblioteca_data(request, slug):
         'genres_with_counts': genres_with_counts,
         'selected_genres': selected_genres,
     }
-    
+
     titles_html = render_to_string('catalog/_titles_grid.html', titles_context, request=request)
     genres_html = render_to_string('catalog/_genres_list.html', genres_context, request=request)
-    
+
     return JsonResponse({'titles_html': titles_html, 'genres_html': genres_html})
 
 
-def title_detail(request, title_id):
+async def _asimilar_titles(request, title):
+    """
+    Precomputed neighbours of `title` (see catalog.similarity) available on the
+    platforms selected in the request, most similar first.
+    """
+    keys = similarity.similar_keys(title.tmdb_id, title.type)
+    if not keys:
+        return []
+    rank = {key: i for i, key in enumerate(keys)}
+    qs = Title.objects.live().filter(tmdb_id__in={similarity.decode_key(k)[0] for k in keys}).exclude(tmdb_id=title.tmdb_id)
+    selected = request.GET.getlist('platforms')
+    if selected:
+        qs = qs.filter(platform__slug__in=selected)
+
+    # one card per title even when it is on several of the selected platforms
+    best = {}
+    async for pk, tmdb_id, t_type in qs.order_by('pk').values_list('pk', 'tmdb_id', 'type'):
+        key = similarity.encode_key(tmdb_id, t_type)
+        if key in rank and key not in best:
+            best[key] = pk
+    ids = [best[key] for key in sorted(best, key=rank.get)[:SIMILAR_LIMIT]]
+    if not ids:
+        return []
+    position = {pk: i for i, pk in enumerate(ids)}
+    similar = await rows.atitle_rows(rows.row_queryset(Title.objects.filter(pk__in=ids)))
+    return sorted(similar, key=lambda r: position[r.id])
+
+
+@metrics.timed('catalog_view_seconds', view='title_detail')
+@singleflight.coalesce
+async def title_detail(request, title_id):
     """
     AJAX endpoint to get details of a single title.
     Returns JSON with HTML of the title detail card.
     """
-    title = get_object_or_404(Title, id=title_id)
-    
+    try:
+        title = await Title.objects.live().select_related('platform').prefetch_related('genres').aget(id=title_id)
+    except Title.DoesNotExist:
+        raise Http404('No Title matches the given query.')
+
     context = {
         'title': title,
+        'similar': await _asimilar_titles(request, title),
     }
-    
+
     detail_html = render_to_string('catalog/_title_detail.html', context, request=request)
-    
+
     return JsonResponse({'detail_html': detail_html})
+
+
+@metrics.timed('catalog_view_seconds', view='changes')
+async def changes(request):
+    """
+    Catalog change feed: JSON list of the changes with a sequence number greater than
+    `since` (oldest first, at most CHANGES_LIMIT), optionally for one `platform` slug
+    and one `change` kind. Clients pass the returned `last` as the next `since` while
+    `more` is true.
+    """
+    try:
+        since = max(int(request.GET.get('since', 0)), 0)
+    except ValueError:
+        return JsonResponse({'error': 'since must be an integer'}, status=400)
+
+    qs = CatalogChange.objects.filter(id__gt=since).select_related('platform').order_by('id')
+    if request.GET.get('platform'):
+        qs = qs.filter(platform__slug=request.GET['platform'])
+    if request.GET.get('change'):
+        qs = qs.filter(change=request.GET['change'])
+
+    feed = [{
+        'seq': c.id,
+        'platform': c.platform.slug,
+        'type': c.type,
+        'tmdb_id': c.tmdb_id,
+        'change': c.change,
+        'title': c.title,
+        'popularity': c.popularity,
+        'previous_popularity': c.previous_popularity,
+        'at': c.created_at.isoformat(),
+    } async for c in qs[:CHANGES_LIMIT + 1]]
+    more = len(feed) > CHANGES_LIMIT
+    feed = feed[:CHANGES_LIMIT]
+    return JsonResponse({'changes': feed, 'last': feed[-1]['seq'] if feed else since, 'more': more})
+
+
+def metrics_view(request):
+    """
+    Prometheus text exposition of catalog and TMDB sync metrics.
+    Allowed for staff users or with `Authorization: Bearer <settings.METRICS_TOKEN>`.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    auth = request.headers.get('Authorization', '')
+    authorized = request.user.is_staff or (token and hmac.compare_digest(auth, f'Bearer {token}'))
+    if not authorized:
+        return HttpResponse('Forbidden', status=403, content_type='text/plain')
+    return HttpResponse(metrics.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def poster(request, size, name):
+    """
+    Local thumbnail cache/proxy for TMDB posters (enabled with settings.POSTER_CACHE_DIR).
+    Each size is downloaded once and then served from disk.
+    """
+    if posters.cache_dir() is None:
+        raise Http404('Poster cache disabled')
+    try:
+        fname, downloaded = posters.fetch_to_cache(size, name, catalog_only=True)
+    except ValueError:
+        raise Http404('Unknown poster')
+    except requests.RequestException:
+        return HttpResponse('Upstream image error', status=502, content_type='text/plain')
+    metrics.inc('cache_requests_total', cache='posters', result='miss' if downloaded else 'hit')
+    resp = FileResponse(open(fname, 'rb'), content_type=mimetypes.guess_type(name)[0] or 'image/jpeg')
+    # a poster path never changes content on TMDB
+    resp['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return resp
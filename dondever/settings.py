@@ -26,11 +26,15 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    # WhiteNoise plus the pre-rendered library pages (catalog.prerender)
+    'catalog.middleware.PrerenderedWhiteNoiseMiddleware',
+    # gzip/brotli for the dynamic catalog views (catalog.compression)
+    'catalog.middleware.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'catalog.middleware.PrimaryDatabaseForAdminMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -41,8 +45,14 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
-        'APP_DIRS': True,
         'OPTIONS': {
+            # the AJAX partials (templates/**/_*.html) are minified when loaded
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'catalog.template_loaders.FilesystemLoader',
+                    'catalog.template_loaders.AppDirectoriesLoader',
+                ]),
+            ],
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -54,17 +64,34 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'dondever.wsgi.application'
+# Production runs under uvicorn workers (see Procfile); WSGI is kept for manage.py tools
+ASGI_APPLICATION = 'dondever.asgi.application'
 
 # Database configuration: prefer DATABASE_URL (Postgres on Supabase), fallback to sqlite for local dev
-DATABASE_URL = os.environ.get('DATABASE_URL')
-if DATABASE_URL:
-    parsed_db = dj_database_url.parse(DATABASE_URL, conn_max_age=600)
+# DATABASE_POOL=1 uses psycopg 3 server-side connection pooling (Django >= 5.1) instead of
+# persistent connections; DATABASE_POOL_MIN/MAX size the pool per worker process.
+DATABASE_POOL = os.environ.get('DATABASE_POOL', '').lower() in ('1', 'true', 'yes')
+
+
+def _database_from_url(url):
+    parsed_db = dj_database_url.parse(url, conn_max_age=0 if DATABASE_POOL else 600)
     # Ensure SSL is used for Supabase/Postgres in production
     parsed_db.setdefault('OPTIONS', {})
-    # If the URL doesn't already specify sslmode, require SSL
-    if 'sslmode' not in DATABASE_URL:
-        parsed_db['OPTIONS'].setdefault('sslmode', 'require')
-    DATABASES = {'default': parsed_db}
+    if parsed_db['ENGINE'] == 'django.db.backends.postgresql':
+        # If the URL doesn't already specify sslmode, require SSL
+        if 'sslmode' not in url:
+            parsed_db['OPTIONS'].setdefault('sslmode', 'require')
+        if DATABASE_POOL:
+            parsed_db['OPTIONS']['pool'] = {
+                'min_size': int(os.environ.get('DATABASE_POOL_MIN', 2)),
+                'max_size': int(os.environ.get('DATABASE_POOL_MAX', 10)),
+            }
+    return parsed_db
+
+
+DATABASE_URL = os.environ.get('DATABASE_URL')
+if DATABASE_URL:
+    DATABASES = {'default': _database_from_url(DATABASE_URL)}
 else:
     DATABASES = {
         'default': {
@@ -73,6 +100,20 @@ else:
         }
     }
 
+# Optional read replica for the public catalog views. Locally it can be a second SQLite
+# file, e.g. DATABASE_REPLICA_URL=sqlite:///replica.sqlite3 (see catalog.routers).
+DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+if DATABASE_REPLICA_URL:
+    DATABASES['replica'] = _database_from_url(DATABASE_REPLICA_URL)
+    # tests run against a single database
+    DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
+
+DATABASE_ROUTERS = ['catalog.routers.PrimaryReplicaRouter']
+# After a TMDB sync, reads stay on the primary this many seconds (read-your-writes)
+DATABASE_REPLICA_STICKY_SECONDS = int(os.environ.get('DATABASE_REPLICA_STICKY_SECONDS', 30))
+# Cache alias holding that pin; it must be shared by the workers to be seen by all of them
+DATABASE_REPLICA_PIN_CACHE = 'default'
+
 AUTH_PASSWORD_VALIDATORS = []
 
 LANGUAGE_CODE = 'es-ar'
@@ -94,6 +135,76 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 TMDB_API_KEY = os.environ.get('TMDB_API_KEY', 'f966b7e3d2a3791edbf0823b996c002e')
 # Seconds to wait between TMDB requests to help avoid rate limits (float)
 TMDB_REQUEST_DELAY = 0.10
+# Seconds before the cached TMDB genre lists (catalog.reference) are refetched
+TMDB_REFERENCE_TTL = 7 * 24 * 3600
+# Region used for TMDB watch-provider discovery
+TMDB_WATCH_REGION = os.environ.get('TMDB_WATCH_REGION', 'AR')
+# Regions crawled by the planned multi-region syncs (catalog.planner, plan_sync --execute)
+TMDB_SYNC_REGIONS = [r for r in os.environ.get('TMDB_SYNC_REGIONS', TMDB_WATCH_REGION).split(',') if r]
+# Titles staged per transaction during a sync
+TMDB_INGEST_BATCH_SIZE = 500
+# Discover pages the sync's fetch thread may download ahead of the DB writes (catalog.pipeline)
+TMDB_PIPELINE_QUEUE_PAGES = 4
+# Directory of the <platform>-<kind>.json TMDB snapshots
+TMDB_SNAPSHOT_DIR = BASE_DIR / 'data'
+# Discover pages committed per sync checkpoint: a crashed sync resumed with
+# resume=True re-fetches at most this many pages (catalog.checkpoints)
+TMDB_CHECKPOINT_PAGES = 1
+# Fraction by which TMDB's total_pages may change before a checkpoint is discarded
+TMDB_CHECKPOINT_PAGE_DRIFT = 0.05
+# Delete the replaced generation of titles in a background thread after a sync
+TMDB_GC_IN_BACKGROUND = True
+
+# Pre-rendered hot library pages, refreshed after each TMDB sync or admin change
+PRERENDER_ENABLED = True
+PRERENDER_ROOT = BASE_DIR / 'prerendered'
+# first N pages of each pre-rendered selection
+PRERENDER_PAGES = 3
+PRERENDER_IN_BACKGROUND = True
+
+# "Similar titles" index (manage.py build_similarity), refreshed after each TMDB sync
+SIMILARITY_ENABLED = True
+SIMILARITY_INDEX_PATH = BASE_DIR / 'data' / 'similarity.npz'
+SIMILARITY_TOP_K = 12
+SIMILARITY_IN_BACKGROUND = True
+
+# Single-flight coalescing of identical concurrent catalog requests. Within a process it
+# is always on; set SINGLEFLIGHT_CACHE to a cache alias shared by all workers (e.g. Redis)
+# to coalesce across processes as well.
+SINGLEFLIGHT_ENABLED = True
+SINGLEFLIGHT_CACHE = None
+if os.environ.get('REDIS_URL'):
+    # needs the `redis` package
+    CACHES = {
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        'shared': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': os.environ['REDIS_URL']},
+    }
+    SINGLEFLIGHT_CACHE = 'shared'
+    DATABASE_REPLICA_PIN_CACHE = 'shared'
+# seconds a request waits for the in-flight one before computing its own response
+SINGLEFLIGHT_TIMEOUT = 10
+SINGLEFLIGHT_POLL_INTERVAL = 0.05
+
+# Admin changelists of large tables (catalog.admin_paging): filtered lists count at most this many rows
+ADMIN_COUNT_LIMIT = 10000
+
+# Compression of dynamic catalog responses (manage.py bench_compression compares levels)
+COMPRESSION_ENABLED = True
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_GZIP_LEVEL = 6
+COMPRESSION_BROTLI_QUALITY = 5
+
+# TMDB image CDN; poster URLs are built as <base>/<size>/<poster_path>
+TMDB_IMAGE_BASE = 'https://image.tmdb.org/t/p'
+# Directory for the local poster cache served at /poster/<size>/<name>; unset = link TMDB directly
+POSTER_CACHE_DIR = os.environ.get('POSTER_CACHE_DIR') or None
+
+# Metrics (/metrics, manage.py sync_stats). Each process writes its samples to METRICS_DIR,
+# which must be shared by all the workers; /metrics sums them (catalog.metrics)
+METRICS_DIR = os.environ.get('METRICS_DIR') or BASE_DIR / 'metrics'
+METRICS_FLUSH_INTERVAL = 5
+# Bearer token accepted by /metrics besides a staff session
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
 
 # Security settings for production
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')